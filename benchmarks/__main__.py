@@ -0,0 +1,225 @@
+# Benchmarks for building collabs and for the Spotify I/O layer
+# Usage: python -m benchmarks [--filter TEXT] [--repeat N] [--save FILE] [--compare FILE]
+#
+# Each case reports its best wall time over the repeats, its peak memory, and for
+# the Spotify cases, the number of requests made and the bytes received
+# Save a baseline with --save, then check later runs against it with --compare,
+# which exits with an error if any case got slower, bigger, or chattier
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from squadify.make_collab import Track, CollabBuilder, BitsetCollabBuilder
+from .fake_spotify import FakeSpotifyAPI
+from .squads import make_spotify_track, make_squad, make_playlists
+
+
+# Allowed slowdown or memory growth over the baseline before it counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+# Each case is a function that sets up its inputs and returns a function that
+# runs the measured code and returns a dictionary of counts
+CASES = dict()
+
+
+def case(name):
+    def decorator(setup):
+        CASES[name] = setup
+        return setup
+    return decorator
+
+
+def collab_build_case(num_members, playlist_size, overlap, max_collab_size):
+    for engine, builder_class in (("linked", CollabBuilder), ("bitset", BitsetCollabBuilder)):
+        @case(f"collab/build/{engine}/members={num_members}/size={playlist_size}/overlap={overlap}/max={max_collab_size}")
+        def setup(builder_class=builder_class):
+            builder = builder_class(make_playlists(num_members, playlist_size, overlap), max_collab_size)
+            return lambda: dict(collab_size=len(builder.build()))
+
+
+collab_build_case(5, 500, 0.3, 50)
+collab_build_case(20, 2500, 0.3, 50)
+collab_build_case(20, 2500, 0.8, 50)
+collab_build_case(200, 300, 0.5, 2000)
+collab_build_case(200, 1000, 0.8, 2000)
+
+
+def collab_variants_case(num_members, playlist_size, overlap, num_variants):
+    for engine, builder_class in (("linked", CollabBuilder), ("bitset", BitsetCollabBuilder)):
+        @case(f"collab/variants/{engine}/members={num_members}/size={playlist_size}/overlap={overlap}/variants={num_variants}")
+        def setup(builder_class=builder_class):
+            builder = builder_class(make_playlists(num_members, playlist_size, overlap))
+            return lambda: dict(collabs=len(builder.build_variants(range(num_variants))))
+
+
+collab_variants_case(10, 1000, 0.3, 5)
+collab_variants_case(20, 2500, 0.3, 5)
+collab_variants_case(200, 1000, 0.8, 5)
+
+
+@case("collab/create_track_list/members=20/size=2500")
+def setup_create_track_list():
+    builder = CollabBuilder(make_playlists(20, 2500, 0.3))
+    def run():
+        builder._CollabBuilder__create_track_list()
+        return dict(tracks=len(builder.tracks))
+    return run
+
+
+@case("collab/link_tracks/members=20/size=2500")
+def setup_link_tracks():
+    builder = CollabBuilder(make_playlists(20, 2500, 0.3))
+    builder._CollabBuilder__create_track_list()
+    def run():
+        builder._CollabBuilder__link_tracks()
+        return dict()
+    return run
+
+
+# Return a function that runs f against the fake Spotify API and returns its
+# request counts
+def counting_requests(spotify_api, f):
+    def run():
+        spotify_api.reset_counters()
+        f()
+        counts = {f"{method} {endpoint}": count for (method, endpoint), count in sorted(spotify_api.calls.items())}
+        counts["requests"] = sum(spotify_api.calls.values())
+        counts["bytes_received"] = spotify_api.bytes_received
+        return counts
+    return run
+
+
+@case("spotify/pull_tracks/tracks=5000")
+def setup_pull_tracks():
+    spotify_api = FakeSpotifyAPI()
+    playlist_id = spotify_api.add_playlist("Big Playlist", range(5000))
+    return counting_requests(spotify_api, lambda: spotify_api.get_playlist_tracks(playlist_id))
+
+
+@case("spotify/pull_tracks/tracks=5000/latency=0.02")
+def setup_pull_tracks_with_latency():
+    spotify_api = FakeSpotifyAPI(latency=0.02)
+    playlist_id = spotify_api.add_playlist("Big Playlist", range(5000))
+    return counting_requests(spotify_api, lambda: spotify_api.get_playlist_tracks(playlist_id))
+
+
+@case("spotify/get_playlist_changes/members=15/size=500/latency=0.02")
+def setup_get_playlist_changes():
+    spotify_api = FakeSpotifyAPI(latency=0.02)
+    members_and_ids = [
+        (f"Member {member}", spotify_api.add_playlist(f"Playlist {member}", numbers))
+        for member, numbers in enumerate(make_squad(15, 500, 0.3))
+    ]
+    # Nothing indexed yet, so every playlist is downloaded, like a squad's first compile
+    return counting_requests(spotify_api, lambda: spotify_api.get_playlist_changes(members_and_ids, dict()))
+
+
+@case("spotify/create_playlist_with_tracks/tracks=2000")
+def setup_create_playlist_with_tracks():
+    spotify_api = FakeSpotifyAPI()
+    spotify_api.add_playlist("Source", range(2000))  # So the fake knows these tracks
+    tracks = [Track(make_spotify_track(number)) for number in range(2000)]
+    return counting_requests(spotify_api, lambda: spotify_api.create_playlist_with_tracks("Collab", tracks))
+
+
+# Keeps Liked Songs sync markers in memory, like database.MongoLikedSongsSync
+class MemoryLikedSongsSync:
+    def __init__(self):
+        self.markers = dict()
+
+    def get_sync_marker(self, user_id):
+        return self.markers.get(user_id)
+
+    def save_sync_marker(self, user_id, playlist_id, last_added_at, track_count):
+        self.markers[user_id] = dict(playlist_id=playlist_id, last_added_at=last_added_at, track_count=track_count)
+
+
+@case("spotify/clone_liked_songs/saved=5000/first_sync")
+def setup_liked_songs_first_sync():
+    spotify_api = FakeSpotifyAPI(liked_songs_sync=MemoryLikedSongsSync())
+    spotify_api.add_saved_tracks(range(5000))
+    return counting_requests(spotify_api, spotify_api.clone_liked_songs)
+
+
+@case("spotify/clone_liked_songs/saved=5000/resync_after_10_likes")
+def setup_liked_songs_resync():
+    spotify_api = FakeSpotifyAPI(liked_songs_sync=MemoryLikedSongsSync())
+    spotify_api.add_saved_tracks(range(5000))
+    spotify_api.clone_liked_songs()
+    spotify_api.add_saved_tracks(range(5000, 5010))
+    return counting_requests(spotify_api, spotify_api.clone_liked_songs)
+
+
+# Return the best time, peak memory and counts of a case
+def measure(setup, repeat):
+    best_time = None
+    for _ in range(repeat):
+        run = setup()
+        start = time.perf_counter()
+        counts = run()
+        elapsed = time.perf_counter() - start
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+
+    # Measure memory separately since tracing slows everything down
+    run = setup()
+    tracemalloc.start()
+    run()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return dict(time_s=best_time, peak_mib=peak_memory / 2**20, counts=counts)
+
+
+# Return a description of each way a result regressed from its baseline
+def find_regressions(result, baseline, tolerance):
+    regressions = []
+    if result["time_s"] > baseline["time_s"] * (1 + tolerance):
+        regressions.append(f"time {baseline['time_s'] * 1000:.1f} ms -> {result['time_s'] * 1000:.1f} ms")
+    if result["peak_mib"] > baseline["peak_mib"] * (1 + tolerance):
+        regressions.append(f"peak memory {baseline['peak_mib']:.2f} MiB -> {result['peak_mib']:.2f} MiB")
+    for name, count in result["counts"].items():
+        if name in baseline["counts"] and count > baseline["counts"][name]:
+            regressions.append(f"{name} {baseline['counts'][name]} -> {count}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results to a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    baselines = dict()
+    if args.compare:
+        with open(args.compare) as file:
+            baselines = json.load(file)
+
+    results = dict()
+    num_regressions = 0
+    for name, setup in CASES.items():
+        if args.filter not in name:
+            continue
+        result = results[name] = measure(setup, args.repeat)
+
+        counts = ", ".join(f"{key}={value}" for key, value in result["counts"].items())
+        print(f"{name}\n    {result['time_s'] * 1000:9.1f} ms {result['peak_mib']:9.2f} MiB    {counts}")
+        if name in baselines:
+            for regression in find_regressions(result, baselines[name], args.tolerance):
+                print(f"    REGRESSION: {regression}")
+                num_regressions += 1
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=4, sort_keys=True)
+    if num_regressions:
+        sys.exit(f"{num_regressions} regressions")
+
+
+if __name__ == "__main__":
+    main()
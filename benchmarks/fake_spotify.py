@@ -0,0 +1,218 @@
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse, parse_qsl
+from spotipy import SpotifyException
+from squadify.spotify_api import SpotifyAPI
+from .squads import make_spotify_track
+
+
+API_PREFIX = "https://api.spotify.com/v1/"
+
+
+# The Spotify Web API's users, playlists and saved tracks, kept in memory, and its
+# answers to requests for them, paginated like the real thing
+# Used in-process by FakeSpotifyAPI, and over HTTP by the load test's fake server,
+# which can have many users making requests at once
+class FakeWebAPI:
+
+    def __init__(self, api_prefix=API_PREFIX):
+        self.api_prefix = api_prefix  # Base URL of the links to next pages
+        self.users = dict()  # User ID -> dict(id, display_name)
+        self.playlists = dict()  # Playlist ID -> dict(name, owner, followers, tracks, snapshot)
+        self.saved_tracks = dict()  # User ID -> (added_at, track) pairs, newest first
+        self.tracks_by_id = dict()
+        self.playlist_numbers = itertools.count()
+        self.lock = threading.Lock()
+
+    # Add a user and return their profile
+    def add_user(self, user_id, display_name):
+        with self.lock:
+            user = self.users[user_id] = dict(id=user_id, display_name=display_name)
+            self.saved_tracks[user_id] = []
+        return user
+
+    # Add a playlist with the given track numbers and return its ID
+    def add_playlist(self, name, numbers, owner):
+        with self.lock:
+            return self.__add_playlist(name, numbers, owner)
+
+    # Have the user like the given track numbers, with the first one being the newest
+    def add_saved_tracks(self, user_id, numbers):
+        with self.lock:
+            saved_tracks = self.saved_tracks[user_id]
+            newest_added_at = 1_600_000_000 + len(saved_tracks) + len(numbers)
+            self.saved_tracks[user_id] = [
+                (time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(newest_added_at - i)), self.__track(number))
+                for i, number in enumerate(numbers)
+            ] + saved_tracks
+
+    # Answer a request the user made, given its path after /v1/ and its query parameters
+    # Raises SpotifyException like Spotipy would for an error response
+    def respond(self, user_id, method, url, payload, params):
+        with self.lock:
+            return self.__respond(user_id, method, url, payload, params)
+
+    def __respond(self, user_id, method, url, payload, params):
+        if url == "me":
+            return self.users[user_id]
+        if url == "me/tracks":
+            items = [dict(added_at=added_at, track=track) for added_at, track in self.saved_tracks[user_id]]
+            return self.__page(url, items, params)
+        if url == "me/playlists":
+            items = [
+                dict(id=playlist_id, name=playlist["name"], owner=dict(id=playlist["owner"]))
+                for playlist_id, playlist in self.playlists.items()
+                if user_id in playlist["followers"]  # Like Spotify, deleting a playlist unfollows it
+            ]
+            return self.__page(url, items, params)
+        if re.fullmatch(r"users/[^/]+/playlists", url) and method == "POST":
+            return dict(id=self.__add_playlist(payload["name"], [], user_id), snapshot_id="0")
+
+        match = re.fullmatch(r"playlists/([^/]+)(/items|/tracks|/followers|/followers/contains)?", url)
+        playlist = self.playlists.get(match.group(1)) if match else None
+        if playlist is None:
+            raise SpotifyException(404, -1, f"{self.api_prefix}{url}:\n Resource not found")
+
+        # Deleting a playlist only unfollows it, and the owner can still read and change it
+        if match.group(2) == "/followers/contains":
+            return [user_id in playlist["followers"] for user_id in params.get("ids", user_id).split(",")]
+        if match.group(2) == "/followers":
+            if method == "PUT":
+                playlist["followers"].add(user_id)
+            elif method == "DELETE":
+                playlist["followers"].discard(user_id)
+            return None
+
+        if match.group(2) is None:
+            return dict(id=match.group(1), name=playlist["name"], snapshot_id=str(playlist["snapshot"]))
+        if method == "GET":
+            page = self.__page(url, [dict(track=track) for track in playlist["tracks"]], params)
+            return filter_fields(page, parse_fields(params["fields"])) if "fields" in params else page
+
+        # Every other method modifies the playlist
+        playlist["snapshot"] += 1
+        if method == "POST":
+            tracks = [self.tracks_by_id[uri.split(":")[-1]] for uri in payload]
+            position = int(params.get("position", len(playlist["tracks"])))
+            playlist["tracks"][position:position] = tracks
+        elif method == "PUT":
+            playlist["tracks"] = [self.tracks_by_id[uri.split(":")[-1]] for uri in payload["uris"]]
+        elif method == "DELETE":
+            track_ids = set(item["uri"].split(":")[-1] for item in payload["items"])
+            playlist["tracks"] = [track for track in playlist["tracks"] if track["id"] not in track_ids]
+        return dict(snapshot_id=str(playlist["snapshot"]))
+
+    def __add_playlist(self, name, numbers, owner):
+        playlist_id = f"playlist{next(self.playlist_numbers)}"
+        self.playlists[playlist_id] = dict(
+            name=name,
+            owner=owner,
+            followers={owner},
+            tracks=[self.__track(number) for number in numbers],
+            snapshot=0,
+        )
+        return playlist_id
+
+    # Return one page of items, linking to the next page like the Web API does
+    def __page(self, url, items, params):
+        limit = int(params.get("limit", 20))
+        offset = int(params.get("offset", 0))
+        query = "".join(f"&{key}={value}" for key, value in params.items() if key not in ("limit", "offset"))
+        next_url = None
+        if offset + limit < len(items):
+            next_url = f"{self.api_prefix}{url}?offset={offset + limit}&limit={limit}{query}"
+        return dict(
+            href=f"{self.api_prefix}{url}?offset={offset}&limit={limit}{query}",
+            items=items[offset : offset + limit],
+            limit=limit,
+            offset=offset,
+            total=len(items),
+            next=next_url,
+        )
+
+    def __track(self, number):
+        track = make_spotify_track(number)
+        self.tracks_by_id[track["id"]] = track
+        return track
+
+
+# A SpotifyAPI whose requests are answered offline by a FakeWebAPI, as its one user
+# Every request is counted, and its response is serialized and parsed as JSON so
+# that the bytes on the wire and the parsing cost are part of the measurements
+class FakeSpotifyAPI(SpotifyAPI):
+
+    def __init__(self, latency=0, **kwargs):
+        super().__init__(auth="fake-token", **kwargs)
+        self.latency = latency  # Seconds each request takes
+
+        self.web_api = FakeWebAPI()
+        self.user = self.web_api.add_user("fake-user", "Fake User")
+        self.playlists = self.web_api.playlists
+        self.tracks_by_id = self.web_api.tracks_by_id
+
+        self.calls = Counter()  # (method, endpoint) -> number of requests
+        self.bytes_received = 0
+
+    # Add a playlist with the given track numbers and return its ID
+    def add_playlist(self, name, numbers):
+        return self.web_api.add_playlist(name, numbers, self.user["id"])
+
+    # Like the given track numbers, with the first one being the newest
+    def add_saved_tracks(self, numbers):
+        self.web_api.add_saved_tracks(self.user["id"], numbers)
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.bytes_received = 0
+
+    def _internal_call(self, method, url, payload, params):
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        if url.startswith("http"):
+            params.update(parse_qsl(urlparse(url).query))
+            url = urlparse(url).path[len("/v1/"):]
+        url = url.rstrip("/")
+        endpoint = re.sub(r"^playlists/[^/]+", "playlists/{id}", url)
+        endpoint = re.sub(r"^users/[^/]+", "users/{id}", endpoint)
+        self.calls[(method, endpoint)] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        response = json.dumps(self.web_api.respond(self.user["id"], method, url, payload, params))
+        self.bytes_received += len(response)
+        return json.loads(response)
+
+
+# Parse a Web API fields parameter like "items(track(id,name)),next" into a
+# dictionary from each field to the fields kept inside it, or None to keep all of it
+def parse_fields(fields):
+    parsed = dict()
+    stack = [parsed]
+    name = ""
+    for char in fields + ",":
+        if char in ",()" and name:
+            stack[-1][name] = None
+        if char == "(":
+            stack[-1][name] = dict()
+            stack.append(stack[-1][name])
+        elif char == ")":
+            stack.pop()
+        if char in ",()":
+            name = ""
+        else:
+            name += char
+    return parsed
+
+
+# Return a copy of a response with only the given parsed fields
+def filter_fields(value, fields):
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [filter_fields(item, fields) for item in value]
+    if isinstance(value, dict):
+        return {key: filter_fields(value[key], subfields) for key, subfields in fields.items() if key in value}
+    return value
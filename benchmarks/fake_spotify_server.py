@@ -0,0 +1,176 @@
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl, urlencode
+from spotipy import SpotifyException
+from .fake_spotify import FakeWebAPI
+
+
+TOKEN_LIFETIME = 3600  # Seconds an access token lasts
+
+
+# A local HTTP server standing in for the Spotify accounts service and Web API,
+# so the app can be run against it by pointing SPOTIFY_ACCOUNTS_URL at url and
+# SPOTIFY_API_URL at url + "/v1/"
+# Everyone who signs in becomes a new user who has liked saved_tracks tracks
+# drawn from the first track_pool track numbers
+# Every request takes latency seconds, and with a rate_limit, Web API requests
+# beyond that many a second are answered with a 429 and a Retry-After like
+# Spotify's own rate limiting
+class FakeSpotifyServer:
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, rate_limit=None, saved_tracks=0, track_pool=1000, seed=0):
+        self.http_server = ThreadingHTTPServer((host, port), FakeSpotifyHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.fake = self
+        self.url = f"http://{host}:{self.http_server.server_port}"
+        self.web_api = FakeWebAPI(api_prefix=f"{self.url}/v1/")
+
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.saved_tracks = saved_tracks
+        self.track_pool = track_pool
+        self.random = random.Random(seed)
+
+        self.codes = dict()  # Authorization code -> (user ID, scope)
+        self.tokens = dict()  # Access or refresh token -> (user ID, or None for the app itself, scope)
+        self.numbers = itertools.count()  # For naming users, codes and tokens
+        self.lock = threading.Lock()
+        self.window = (0, 0)  # (Second, number of Web API requests let through in it)
+        self.responses = Counter()  # HTTP status -> number of responses
+
+    def start(self):
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    # Sign in a new user, and return the URL Spotify would send them back to
+    def authorize(self, params):
+        with self.lock:
+            number = next(self.numbers)
+            saved_tracks = self.random.sample(range(self.track_pool), min(self.saved_tracks, self.track_pool))
+        user_id = f"user{number}"
+        self.web_api.add_user(user_id, f"User {number}")
+        self.web_api.add_saved_tracks(user_id, saved_tracks)
+
+        code = f"code{number}"
+        self.codes[code] = (user_id, params.get("scope", ""))
+        query = dict(code=code)
+        if "state" in params:
+            query["state"] = params["state"]
+        return f"{params['redirect_uri']}?{urlencode(query)}"
+
+    # Answer a request to the token endpoint with a new token, or an error
+    # Returns (status, response)
+    def issue_token(self, form):
+        grant_type = form.get("grant_type")
+        if grant_type == "authorization_code" and form.get("code") in self.codes:
+            user_id, scope = self.codes.pop(form["code"])
+        elif grant_type == "refresh_token" and form.get("refresh_token") in self.tokens:
+            user_id, scope = self.tokens[form["refresh_token"]]
+        elif grant_type == "client_credentials":
+            user_id, scope = None, ""
+        else:
+            return 400, dict(error="invalid_grant")
+
+        with self.lock:
+            number = next(self.numbers)
+        token = dict(access_token=f"access{number}", token_type="Bearer", expires_in=TOKEN_LIFETIME, scope=scope)
+        self.tokens[token["access_token"]] = (user_id, scope)
+        if user_id is not None:
+            token["refresh_token"] = form.get("refresh_token", f"refresh{number}")
+            self.tokens[token["refresh_token"]] = (user_id, scope)
+        return 200, token
+
+    # Return whether a Web API request is over the rate limit, counting it if it isn't
+    def rate_limited(self):
+        if self.rate_limit is None:
+            return False
+        with self.lock:
+            second = int(time.time())
+            window_second, count = self.window
+            if window_second != second:
+                window_second, count = second, 0
+            if count >= self.rate_limit:
+                return True
+            self.window = (window_second, count + 1)
+            return False
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+
+    # Keep connections open like Spotify does, so the app's connection pool is used
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        if url.path == "/authorize":
+            return self.respond(302, None, Location=fake.authorize(params))
+        if url.path == "/api/token":
+            return self.respond(*fake.issue_token(dict(parse_qsl(body.decode()))))
+        if not url.path.startswith("/v1/"):
+            return self.respond(404, error(404, "Service not found"))
+
+        if fake.rate_limited():
+            return self.respond(429, error(429, "API rate limit exceeded"), **{"Retry-After": "1"})
+        authorization = self.headers.get("Authorization", "")
+        token = fake.tokens.get(authorization[len("Bearer "):]) if authorization.startswith("Bearer ") else None
+        if token is None:
+            return self.respond(401, error(401, "Invalid access token"))
+
+        user_id = token[0]
+        path = url.path[len("/v1/"):].rstrip("/")
+        if user_id is None and (path == "me" or path.startswith("me/")):
+            return self.respond(403, error(403, "This request requires user authentication"))
+
+        try:
+            response = fake.web_api.respond(user_id, method, path, json.loads(body) if body else None, params)
+        except SpotifyException as e:
+            return self.respond(e.http_status, error(e.http_status, e.msg))
+        self.respond(201 if method == "POST" else 200, response)
+
+    def respond(self, status, response, **headers):
+        fake = self.server.fake
+        with fake.lock:
+            fake.responses[status] += 1
+        data = json.dumps(response).encode() if response is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Requests aren't logged, there are far too many
+    def log_message(self, format, *args):
+        pass
+
+
+# Return an error response shaped like the Web API's
+def error(status, message):
+    return dict(error=dict(status=status, message=message))
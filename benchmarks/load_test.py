@@ -0,0 +1,290 @@
+# Load test of the app against a local fake of the Spotify API
+# Usage: python -m benchmarks.load_test [--users N] [--duration SECONDS] [--latency SECONDS] [--rate-limit N] ...
+#
+# Starts a FakeSpotifyServer and the app on local ports, then has each virtual
+# user sign in and, until the time is up, create a squad, add playlists and their
+# Liked Songs to it, view it, compile it and wait for the compile to finish, all
+# through the app's real routes over HTTP
+# Reports the p50/p95/p99 latency, throughput and errors of each endpoint
+#
+# Uses an in-memory MongoDB (mongomock, which has to be installed) unless
+# --mongo-uri is given, in which case the data goes in the database named by
+# --mongo-db and is left there
+# The app's other settings, like SPOTIFY_REQUESTS_PER_SECOND and SESSION_BACKEND,
+# are read from the environment as usual
+
+import argparse
+import logging
+import math
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+from collections import defaultdict, Counter
+import requests
+
+
+# A request that failed, after it's been recorded
+class LoadTestError(Exception):
+    pass
+
+
+# Latencies and errors of each endpoint, recorded from every virtual user's thread
+class Stats:
+
+    def __init__(self):
+        self.latencies = defaultdict(list)  # Endpoint -> seconds each successful request took
+        self.errors = Counter()  # Endpoint -> number of failed requests
+        self.events = Counter()  # Outcomes like finished or failed compiles
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            if ok:
+                self.latencies[endpoint].append(seconds)
+            else:
+                self.errors[endpoint] += 1
+
+    def count(self, event):
+        with self.lock:
+            self.events[event] += 1
+
+    # Return a table of each endpoint's throughput and latency percentiles over
+    # a run that took the given number of seconds
+    def report(self, elapsed):
+        lines = [f"{'endpoint':<44} {'requests':>8} {'errors':>6} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+        with self.lock:
+            endpoints = sorted(set(self.latencies) | set(self.errors))
+            for endpoint in endpoints:
+                latencies = sorted(self.latencies[endpoint])
+                num_requests = len(latencies) + self.errors[endpoint]
+                millis = [percentile(latencies, p) * 1000 for p in (50, 95, 99, 100)]
+                lines.append(
+                    f"{endpoint:<44} {num_requests:>8} {self.errors[endpoint]:>6} {num_requests / elapsed:>7.1f} "
+                    + " ".join(f"{value:>8.1f}" for value in millis)
+                )
+            total = sum(len(latencies) for latencies in self.latencies.values()) + sum(self.errors.values())
+            lines.append(f"{total} requests in {elapsed:.1f}s, {total / elapsed:.1f} req/s")
+            lines.append(", ".join(f"{event}: {count}" for event, count in sorted(self.events.items())))
+        return "\n".join(lines)
+
+
+# Nearest-rank percentile of sorted values, or 0 if there are none
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+# One user clicking through the app in a browser: it keeps its own cookies,
+# revalidates the pages it has seen with their ETags, and follows redirects one
+# hop at a time so each hop is timed against its own endpoint
+class VirtualUser:
+
+    def __init__(self, app_url, stats, args, playlist_ids, seed):
+        self.app_url = app_url
+        self.stats = stats
+        self.args = args
+        self.playlist_ids = playlist_ids
+        self.random = random.Random(seed)
+        self.http = requests.Session()
+        self.pages = dict()  # URL -> (ETag, body) of each page seen, like a browser cache
+
+    # Make a request to the app and return the response, following redirects
+    # Requests to the app are timed as "METHOD /path", with squad and job IDs
+    # replaced by <id>; redirects to the fake Spotify aren't timed
+    def request(self, method, url, **kwargs):
+        url = url if url.startswith("http") else self.app_url + url
+        while True:
+            timed = url.startswith(self.app_url)
+            endpoint = f"{method} {re.sub(r'[0-9a-f]{8}-[0-9a-f-]{27}', '<id>', url[len(self.app_url):].split('?')[0])}"
+            headers = dict()
+            if method == "GET" and url in self.pages:
+                headers["If-None-Match"] = self.pages[url][0]
+
+            start = time.perf_counter()
+            try:
+                response = self.http.request(method, url, headers=headers, allow_redirects=False, timeout=60, **kwargs)
+                ok = response.status_code < 400
+            except requests.RequestException:
+                response, ok = None, False
+            if timed:
+                self.stats.record(endpoint, time.perf_counter() - start, ok)
+            if not ok:
+                raise LoadTestError(f"{endpoint}: {response.status_code if response is not None else 'no response'}")
+
+            if response.status_code == 304:
+                response._content = self.pages[url][1]
+            elif "ETag" in response.headers:
+                self.pages[url] = (response.headers["ETag"], response.content)
+            if not response.is_redirect:
+                return response
+            url = requests.compat.urljoin(url, response.headers["Location"])
+            method = "GET"
+            kwargs.pop("data", None)
+
+    # Return the CSRF token of the form on a page
+    def csrf_token(self, response):
+        return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', response.text).group(1)
+
+    def sign_in(self):
+        self.request("GET", "/sign_in?dest=%2Fsquads")
+
+    # Make a squad, add playlists to it, look at it, and compile it
+    def run_iteration(self, number):
+        response = self.request("GET", "/squads/new")
+        response = self.request(
+            "POST", "/squads/new", data=dict(squad_name=f"Load Test {number}", csrf_token=self.csrf_token(response))
+        )
+        squad_path = response.url[len(self.app_url):]
+
+        for member, playlist_id in enumerate(self.random.sample(self.playlist_ids, self.args.squad_size)):
+            response = self.request(
+                "POST",
+                f"{squad_path}/add_playlist",
+                data=dict(
+                    user_name=f"Member {member}",
+                    playlist_link=f"https://open.spotify.com/playlist/{playlist_id}",
+                    csrf_token=self.csrf_token(response),
+                ),
+            )
+        if self.args.saved_tracks > 0:
+            response = self.request(
+                "POST",
+                f"{squad_path}/add_playlist",
+                data=dict(user_name="Me", use_liked_songs="y", csrf_token=self.csrf_token(response)),
+            )
+
+        self.request("GET", squad_path)  # Coming back to the squad later
+        self.compile(squad_path)
+        self.request("GET", "/squads")
+
+    # Compile a squad and poll its progress like the progress page does
+    def compile(self, squad_path):
+        start = time.perf_counter()
+        response = self.request("GET", f"{squad_path}/compile")
+        job_path = response.url[len(self.app_url):]
+        while True:
+            time.sleep(self.args.poll_interval)
+            status = self.request("GET", f"{job_path}/status").json()["status"]
+            if status in ("done", "failed"):
+                break
+        self.request("GET", job_path)
+        self.stats.count(f"compiles {status}")
+        if status == "done":
+            self.stats.record("compile, start to finish", time.perf_counter() - start, True)
+
+    def run(self, deadline):
+        try:
+            self.sign_in()
+        except LoadTestError as e:
+            logging.warning(f"Signing in failed: {e}")
+            self.stats.count("sign ins failed")
+            return
+
+        number = 0
+        while time.time() < deadline:
+            try:
+                self.run_iteration(number)
+                self.stats.count("iterations finished")
+            except LoadTestError as e:
+                logging.warning(f"Iteration failed: {e}")
+                self.stats.count("iterations failed")
+            number += 1
+
+
+# Return a port nobody is listening on
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load_test")
+    parser.add_argument("--users", type=int, default=10, help="number of virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to keep starting new iterations")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which the users start")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds each fake Spotify request takes")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Spotify requests a second before 429s")
+    parser.add_argument("--playlists", type=int, default=100, help="number of playlists on the fake Spotify")
+    parser.add_argument("--playlist-size", type=int, default=300)
+    parser.add_argument("--overlap", type=float, default=0.3, help="share of each playlist drawn from a common pool")
+    parser.add_argument("--squad-size", type=int, default=5, help="playlists added to each squad")
+    parser.add_argument("--saved-tracks", type=int, default=500, help="Liked Songs of each user, 0 to not add them")
+    parser.add_argument("--poll-interval", type=float, default=1, help="seconds between compile progress checks")
+    parser.add_argument("--mongo-uri", default=None, help="use this MongoDB instead of an in-memory one")
+    parser.add_argument("--mongo-db", default="squadify_load_test")
+    args = parser.parse_args()
+
+    # The app reads its settings when it's imported, so they go in first
+    app_port = free_port()
+    spotify_port = free_port()
+    os.environ.update(
+        SPOTIFY_API_URL=f"http://127.0.0.1:{spotify_port}/v1/",
+        SPOTIFY_ACCOUNTS_URL=f"http://127.0.0.1:{spotify_port}",
+        SPOTIPY_CLIENT_ID="load-test",
+        SPOTIPY_CLIENT_SECRET="load-test",
+        SPOTIPY_REDIRECT_URI=f"http://127.0.0.1:{app_port}",
+    )
+    if args.mongo_uri:
+        os.environ.update(MONGO_URI=args.mongo_uri, MONGO_DB_NAME=args.mongo_db)
+
+    from werkzeug.serving import make_server
+    import squadify
+    from squadify import database
+    from .fake_spotify_server import FakeSpotifyServer
+    from .squads import make_squad
+
+    if not args.mongo_uri:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("Install mongomock for an in-memory MongoDB, or pass --mongo-uri")
+        database.client = mongomock.MongoClient()
+    database.ensure_indexes()
+
+    spotify = FakeSpotifyServer(
+        port=spotify_port,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        saved_tracks=args.saved_tracks,
+        track_pool=args.playlist_size * 2,  # The pool the playlists share tracks from
+    )
+    spotify.web_api.add_user("curator", "Curator")
+    playlist_ids = [
+        spotify.web_api.add_playlist(f"Playlist {number}", numbers, "curator")
+        for number, numbers in enumerate(make_squad(args.playlists, args.playlist_size, args.overlap))
+    ]
+    spotify.start()
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    app_server = make_server("127.0.0.1", app_port, squadify.create_app(), threaded=True)
+    threading.Thread(target=app_server.serve_forever, daemon=True).start()
+
+    stats = Stats()
+    start = time.time()
+    deadline = start + args.duration
+    threads = []
+    for number in range(args.users):
+        user = VirtualUser(f"http://127.0.0.1:{app_port}", stats, args, playlist_ids, seed=number)
+        threads.append(threading.Thread(target=user.run, args=(deadline,)))
+        threads[-1].start()
+        time.sleep(args.ramp_up / args.users)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    app_server.shutdown()
+    spotify.stop()
+
+    print(stats.report(elapsed))
+    responses = ", ".join(f"{status}: {count}" for status, count in sorted(spotify.responses.items()))
+    print(f"Fake Spotify responses by status: {responses}")
+
+
+if __name__ == "__main__":
+    main()
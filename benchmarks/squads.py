@@ -0,0 +1,50 @@
+import random
+from squadify.make_collab import Track, Playlist
+
+
+# Return a Spotify track object shaped like the ones the Web API returns, with
+# the album and market data we don't use but still have to download and parse
+def make_spotify_track(number):
+    return dict(
+        id=f"id{number}",
+        name=f"Track {number}",
+        uri=f"spotify:track:id{number}",
+        artists=[dict(id=f"artist{number % 500}", name=f"Artist {number % 500}")],
+        album=dict(
+            id=f"album{number % 2000}",
+            name=f"Album {number % 2000}",
+            images=[dict(url=f"https://i.scdn.co/image/{number}-{size}", height=size, width=size) for size in (64, 300, 640)],
+            available_markets=MARKETS,
+        ),
+        available_markets=MARKETS,
+        duration_ms=180000 + number % 60000,
+        popularity=number % 100,
+    )
+
+
+MARKETS = ["AD", "AR", "AT", "AU", "BE", "BR", "CA", "CH", "DE", "ES", "FR", "GB", "JP", "MX", "US"]
+
+
+# Return the track numbers of each member's playlist in a synthetic squad
+# Each playlist draws about overlap of its tracks from a pool shared by the whole
+# squad, and the rest from tracks only that member owns
+def make_squad(num_members, playlist_size, overlap, seed=0):
+    rng = random.Random(seed)
+    shared_pool = range(playlist_size * 2)
+    num_shared = int(playlist_size * overlap)
+    squad = []
+    for member in range(num_members):
+        numbers = rng.sample(shared_pool, num_shared)
+        first_own_number = playlist_size * 2 + member * playlist_size
+        numbers += range(first_own_number, first_own_number + playlist_size - num_shared)
+        squad.append(numbers)
+    return squad
+
+
+# Return a synthetic squad as a list of Playlists, one per member
+# Every playlist gets its own Track objects, like playlists downloaded from Spotify
+def make_playlists(num_members, playlist_size, overlap, seed=0):
+    return [
+        Playlist(f"Member {member}", [Track(make_spotify_track(number)) for number in numbers])
+        for member, numbers in enumerate(make_squad(num_members, playlist_size, overlap, seed))
+    ]
@@ -1,18 +1,60 @@
+import logging
 import os
-from flask import Flask
-from flask_session import Session
-from .database import SquadConverter
 
 
-app = Flask(__name__)
+# Session settings, read from the environment
+# SECRET_KEY signs session cookies and CSRF tokens, so every worker process has
+# to use the same one; without it each process makes up its own, which only
+# works with a single worker
+SECRET_KEY = os.getenv("SECRET_KEY")
 
-app.url_map.converters["squad"] = SquadConverter
+# Where sessions are kept: "mongodb" stores them in MongoDB with only their ID in
+# the cookie, while "cookie" keeps them in the signed cookie itself, which saves
+# a database round trip on every request but needs SECRET_KEY
+# Sessions only ever hold a session ID and a CSRF token, so they fit in a cookie
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "mongodb")
 
-app.config["SECRET_KEY"] = os.urandom(64)
-app.config["SESSION_TYPE"] = "mongodb"
-app.config["SESSION_MONGODB_DB"] = "squadify"
 
-Session(app)
+# Build the app
+# Nothing connects to MongoDB until a request or command needs it, so creating
+# the app, importing this package, and forking workers are all cheap
+def create_app():
+    from flask import Flask
+    from flask_session import Session
+    from .database import SquadConverter, LazyClient, MONGO_DB_NAME
+    from .metrics import LOG_REQUEST_TIMINGS
+    from . import routes, commands
 
+    app = Flask(__name__)
+    if LOG_REQUEST_TIMINGS:
+        app.logger.setLevel(logging.INFO)
 
-from . import routes
+    app.url_map.converters["squad"] = SquadConverter
+
+    if SESSION_BACKEND == "cookie" and not SECRET_KEY:
+        raise RuntimeError("SESSION_BACKEND=cookie needs SECRET_KEY to be set")
+    app.config["SECRET_KEY"] = SECRET_KEY or os.urandom(64)
+
+    # Flask keeps sessions in signed cookies by default
+    if SESSION_BACKEND == "mongodb":
+        app.config["SESSION_TYPE"] = "mongodb"
+        app.config["SESSION_MONGODB"] = LazyClient()
+        app.config["SESSION_MONGODB_DB"] = MONGO_DB_NAME
+        Session(app)
+    elif SESSION_BACKEND != "cookie":
+        raise RuntimeError(f"Unknown SESSION_BACKEND {SESSION_BACKEND!r}, expected mongodb or cookie")
+
+    app.register_blueprint(routes.blueprint)
+    app.register_blueprint(commands.blueprint)
+
+    return app
+
+
+# squadify.app is created the first time it's used, so that importing any part
+# of this package doesn't build the app
+def __getattr__(name):
+    global app
+    if name == "app":
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,117 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from datetime import datetime
+from multiprocessing import get_context
+from .make_collab import builder_from_track_members
+from .spotify_api import SpotifyAPI, SpotifyClientCredentials
+from .jobs import refresh_track_index
+from . import database
+
+
+BULK_COMPILE_CONCURRENCY = 4  # Max number of squads whose playlists are checked at once
+
+
+# Build a squad's collab in a worker process, given its members, a list of
+# (track document, members who own it) for its popular tracks, and a seed
+# Only documents and lists cross between processes, since a Track's cached hash
+# is only valid in the process that made it
+# Returns the collab as a list of track documents
+def build_collab(members, popular_tracks, seed):
+    track_members = {database.track_from_document(track): set(owners) for track, owners in popular_tracks}
+    collab = builder_from_track_members(members, track_members, seed=seed).build()
+    return [database.track_to_document(track) for track in collab]
+
+
+# Compile every squad that has playlists, for instance from a nightly cron job
+# Each squad's playlists are checked against its track index, at most
+# concurrency squads at a time, and its collab is built in a pool of processes
+# as soon as they're in, so downloading and building overlap and building uses
+# every core
+# Playlists are read with the app's own credentials, so private playlists are
+# skipped, and since nobody's signed in, collabs are stored in each squad's
+# latest_collab instead of being written to anyone's Spotify account
+# Each squad's track index is updated as its playlists come in, and the collabs
+# are written in one bulk write per page of squads
+# Calls report with a line for each squad and a summary at the end, and returns
+# the totals in the summary
+def compile_all_squads(processes=None, concurrency=BULK_COMPILE_CONCURRENCY, seed=None, report=print):
+    # The app's token is only needed for this run, so it's kept in memory instead of a .cache file
+    auth_manager = SpotifyClientCredentials(cache_handler=database.MemoryCacheHandler())
+    spotify_api = SpotifyAPI(auth_manager=auth_manager, track_cache=database.MongoTrackCache())
+    totals = dict(squads=0, failed=0, playlists=0, playlists_skipped=0, tracks=0, indexes_updated=0)
+    start = time.perf_counter()
+
+    # Spawned instead of forked, since forking while other threads are
+    # downloading can copy a lock that's held and never released
+    with ThreadPoolExecutor(concurrency) as downloaders, ProcessPoolExecutor(
+        processes, mp_context=get_context("spawn")
+    ) as builders:
+        after = None
+        while True:
+            squads, after = database.get_squads_to_compile(after)
+            compile_squads(spotify_api, squads, seed, downloaders, builders, totals, report)
+            if after is None:
+                break
+
+    elapsed = time.perf_counter() - start
+    report(
+        f"Compiled {totals['squads'] - totals['failed']} of {totals['squads']} squads in {elapsed:.1f}s "
+        f"({totals['squads'] / elapsed:.2f} squads/s, {totals['playlists'] / elapsed:.1f} playlists/s), "
+        f"{totals['failed']} failed, {totals['playlists_skipped']} playlists skipped, "
+        f"{totals['indexes_updated']} track indexes updated"
+    )
+    return totals
+
+
+# Compile a page of squads and write their results, adding to the totals
+def compile_squads(spotify_api, squads, seed, downloaders, builders, totals, report):
+    refreshes = {downloaders.submit(refresh_track_index, spotify_api, squad): squad for squad in squads}
+    builds = dict()
+    for future in as_completed(refreshes):
+        squad = refreshes[future]
+        totals["squads"] += 1
+        totals["playlists"] += len(squad["playlists"])
+        try:
+            popular_tracks, changed, members, skipped_playlists = future.result()
+        except Exception as e:
+            logging.exception(f"Checking the playlists of squad {squad['squad_id']} failed")
+            report_failure(squad, e, totals, report)
+            continue
+
+        totals["playlists_skipped"] += len(skipped_playlists)
+        if len(members) == 0:
+            report_failure(squad, "none of its playlists could be downloaded", totals, report)
+            continue
+        if changed:
+            totals["indexes_updated"] += 1
+
+        squad_seed = random.randrange(2**32) if seed is None else seed
+        popular_tracks = [
+            (database.track_to_document(track), sorted(owners)) for track, owners in popular_tracks.items()
+        ]
+        future = builders.submit(build_collab, members, popular_tracks, squad_seed)
+        builds[future] = (squad, squad_seed, skipped_playlists)
+
+    collabs = dict()
+    for future in as_completed(builds):
+        squad, squad_seed, skipped_playlists = builds[future]
+        try:
+            tracks = future.result()
+        except Exception as e:
+            logging.exception(f"Building the collab of squad {squad['squad_id']} failed")
+            report_failure(squad, e, totals, report)
+            continue
+
+        collabs[squad["squad_id"]] = dict(seed=squad_seed, tracks=tracks, compiled_at=datetime.utcnow())
+        totals["tracks"] += len(tracks)
+        skipped = "".join(f", skipped {playlist_id} ({reason})" for _, playlist_id, reason in skipped_playlists)
+        report(f"{squad['squad_name']} ({squad['squad_id']}): {len(tracks)} tracks{skipped}")
+
+    database.save_compile_results(collabs)
+
+
+def report_failure(squad, reason, totals, report):
+    totals["failed"] += 1
+    report(f"{squad['squad_name']} ({squad['squad_id']}): FAILED, {reason}")
@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Returned by TTLCache.get when a key isn't cached, since None can be a cached value
+MISSING = object()
+
+
+# A thread-safe in-process cache that holds at most max_size entries
+# Each entry expires at its own time, and once the cache is full, expired entries
+# are evicted before the least recently used ones
+class TTLCache:
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl  # Longest an entry can stay cached, in seconds
+        self.entries = OrderedDict()  # Key -> (expiry time, value), least recently used first
+        self.lock = threading.Lock()
+        self.next_sweep = 0
+
+    # Return the value cached for the key, or MISSING if it isn't cached or expired
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            if entry[0] <= time.time():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    # Cache a value until the ttl passes, or until expires_at if that's sooner
+    def set(self, key, value, expires_at=None):
+        now = time.time()
+        expires_at = min(now + self.ttl, expires_at or float("inf"))
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.__evict(now)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Make room by dropping expired entries, then the least recently used ones
+    # Expired entries are only searched for once a second so a full cache of
+    # live entries doesn't pay for a scan on every insert
+    def __evict(self, now):
+        if now >= self.next_sweep:
+            self.next_sweep = now + 1
+            for key in [key for key, (expires_at, _) in self.entries.items() if expires_at <= now]:
+                del self.entries[key]
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
@@ -0,0 +1,55 @@
+import click
+from flask import Blueprint
+from . import database, bulk_compile
+
+
+# Adds these commands to the flask command instead of a group of their own
+blueprint = Blueprint("commands", __name__, cli_group=None)
+
+
+# Create the MongoDB indexes; run once when deploying and after upgrading
+@blueprint.cli.command("init-db")
+def init_db():
+    database.ensure_indexes()
+    click.echo("Indexes created")
+
+
+# Report how often each index is used and how our main queries are planned
+@blueprint.cli.command("index-stats")
+def index_stats():
+    for collection_name, usage in database.index_usage_stats().items():
+        click.echo(collection_name)
+        for index_name, uses in usage.items():
+            click.echo(f"    {index_name}: {uses} uses")
+
+    for query, plan in database.explain_queries().items():
+        click.echo(f"{query}: {describe_plan(plan)}")
+
+
+# Compile every squad that has playlists, storing each collab in the squad
+# Meant to be run nightly; see bulk_compile.compile_all_squads
+@blueprint.cli.command("compile-all")
+@click.option("--processes", type=int, default=None, help="Number of processes building collabs [default: one per core]")
+@click.option(
+    "--concurrency",
+    type=int,
+    default=bulk_compile.BULK_COMPILE_CONCURRENCY,
+    show_default=True,
+    help="Number of squads whose playlists are checked at once",
+)
+@click.option("--seed", type=int, default=None, help="Seed every collab with this instead of a random seed")
+def compile_all(processes, concurrency, seed):
+    totals = bulk_compile.compile_all_squads(processes, concurrency, seed, report=click.echo)
+    if totals["failed"] > 0:
+        raise SystemExit(1)
+
+
+# Summarize a query plan as its stages from the outermost in, for instance
+# "FETCH <- IXSCAN squad_id_1", or "COLLSCAN" for a collection scan
+def describe_plan(plan):
+    stage = plan["stage"]
+    if "indexName" in plan:
+        stage += " " + plan["indexName"]
+    if "inputStage" in plan:
+        stage += " <- " + describe_plan(plan["inputStage"])
+    return stage
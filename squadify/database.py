@@ -1,36 +1,232 @@
+import os
+import threading
+import time
 import uuid
+from datetime import datetime, timedelta
 from flask import session, abort
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from spotipy.cache_handler import CacheHandler
 from werkzeug.routing import BaseConverter
+from .cache import TTLCache, MISSING
+from .metrics import mongo_operation_seconds
+from .make_collab import Track, MIN_FREQUENCY
 
 
-client = MongoClient("localhost", 27017)
-db = client["squadify"]
-squads_collection = db["squads"]
-spotify_token_collection = db["tokens"]
+# MongoDB connection settings, read from the environment
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "squadify")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))  # Max connections per worker process
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000"))
 
+client = None  # This process's MongoClient, created on first use
+client_lock = threading.Lock()
 
-def get_user_squad_list(spotify_api):
-    return list(squads_collection.find({"leader_id": spotify_api.me()["id"]}))
 
+# Return this process's MongoClient, creating it the first time it's needed
+# MongoClients aren't safe to use across a fork, so a forked worker forgets the
+# parent's client and makes its own
+def get_client():
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                client = MongoClient(
+                    MONGO_URI,
+                    maxPoolSize=MONGO_MAX_POOL_SIZE,
+                    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                    connect=False,
+                )
+    return client
 
+
+def forget_client_after_fork():
+    global client, client_lock
+    client = None
+    client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=forget_client_after_fork)
+
+
+# Stands in for a collection until it's used, then looks it up through this
+# process's client, so importing this module doesn't connect to MongoDB
+class LazyCollection:
+
+    def __init__(self, name, database_name=MONGO_DB_NAME):
+        self.name = name
+        self.database_name = database_name
+
+    def __getattr__(self, attribute):
+        return getattr(get_client()[self.database_name][self.name], attribute)
+
+
+# Stands in for a MongoClient where only collections are looked up from it,
+# like Flask-Session does
+class LazyClient:
+
+    def __getitem__(self, database_name):
+        return LazyDatabase(database_name)
+
+
+class LazyDatabase:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getitem__(self, collection_name):
+        return LazyCollection(collection_name, self.name)
+
+
+squads_collection = LazyCollection("squads")
+spotify_token_collection = LazyCollection("tokens")
+playlist_cache_collection = LazyCollection("playlist_cache")
+liked_songs_collection = LazyCollection("liked_songs")
+jobs_collection = LazyCollection("jobs")
+token_invalidations_collection = LazyCollection("token_invalidations")
+squad_tracks_collection = LazyCollection("squad_tracks")
+indexed_playlists_collection = LazyCollection("indexed_playlists")
+
+PLAYLIST_CACHE_TTL = timedelta(days=30)  # Cached playlists unused for this long are evicted
+PLAYLIST_CACHE_MAX_ENTRIES = 10000  # Max number of playlists kept in the cache
+
+SQUADS_PAGE_SIZE = 20  # Number of squads on each page of the squad list
+COMPILE_PAGE_SIZE = 50  # Number of squads in each page of squads to compile
+
+TOKEN_RETENTION = timedelta(days=30)  # Tokens that haven't been refreshed for this long are deleted
+JOB_RETENTION = timedelta(days=1)  # Compile jobs are deleted this long after they start
+TOKEN_INVALIDATION_RETENTION = timedelta(minutes=10)  # Must be longer than the poll interval plus clock skew
+
+TOKEN_CACHE_SIZE = 10000  # Max number of sessions whose tokens each worker keeps in memory
+TOKEN_CACHE_TTL = 3600  # Longest a token stays in memory, in seconds
+TOKEN_INVALIDATION_POLL_INTERVAL = 2  # Seconds between checks for tokens changed by other workers
+TOKEN_INVALIDATION_CLOCK_SKEW = 5  # Seconds of clock difference between workers to allow for
+
+# In-process cache of each session's token document, in front of the tokens collection
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+last_token_invalidation_poll = time.time()
+
+
+# Create the indexes our queries rely on, including the TTL indexes that expire
+# old tokens, cached playlists, jobs and token invalidations
+# Safe to run again; indexes that already exist are left alone
+def ensure_indexes():
+    squads_collection.create_index("squad_id", unique=True)
+    squads_collection.create_index([("leader_id", ASCENDING), ("_id", ASCENDING)])  # Paging through a user's squads
+
+    remove_duplicate_tokens()
+    spotify_token_collection.create_index("session_id", unique=True)
+    spotify_token_collection.create_index("expire_at", expireAfterSeconds=0)
+
+    playlist_cache_collection.create_index("playlist_id", unique=True)
+    playlist_cache_collection.create_index("last_used", expireAfterSeconds=int(PLAYLIST_CACHE_TTL.total_seconds()))
+
+    liked_songs_collection.create_index("user_id", unique=True)
+
+    jobs_collection.create_index("job_id", unique=True)
+    jobs_collection.create_index("created_at", expireAfterSeconds=int(JOB_RETENTION.total_seconds()))
+
+    token_invalidations_collection.create_index(
+        "invalidated_at", expireAfterSeconds=int(TOKEN_INVALIDATION_RETENTION.total_seconds())
+    )
+
+    squad_tracks_collection.create_index([("squad_id", ASCENDING), ("frequency", ASCENDING)])  # Popular tracks
+    squad_tracks_collection.create_index([("squad_id", ASCENDING), ("owners.playlist_id", ASCENDING)])
+    indexed_playlists_collection.create_index(
+        [("squad_id", ASCENDING), ("playlist_id", ASCENDING), ("user_name", ASCENDING)], unique=True
+    )
+
+
+# Delete all but the newest token of each session, since tokens used to be
+# inserted on every refresh and a unique index can't be built over duplicates
+def remove_duplicate_tokens():
+    duplicates = spotify_token_collection.aggregate(
+        [
+            {"$sort": {"_id": DESCENDING}},
+            {"$group": {"_id": "$session_id", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ]
+    )
+    for duplicate in duplicates:
+        spotify_token_collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+
+
+# Return how many times each index of each collection has been used since the
+# server started, as {collection name: {index name: number of uses}}
+def index_usage_stats():
+    stats = dict()
+    for collection in (
+        squads_collection,
+        spotify_token_collection,
+        playlist_cache_collection,
+        liked_songs_collection,
+        jobs_collection,
+        token_invalidations_collection,
+        squad_tracks_collection,
+        indexed_playlists_collection,
+    ):
+        usage = collection.aggregate([{"$indexStats": {}}])
+        stats[collection.name] = {index["name"]: index["accesses"]["ops"] for index in usage}
+    return stats
+
+
+# Return the winning query plan of each of our most frequent queries, so we can
+# check that they use an index instead of scanning a collection
+def explain_queries():
+    return {
+        "squads by squad_id": squads_collection.find({"squad_id": ""}).explain()["queryPlanner"]["winningPlan"],
+        "squads by leader_id": squads_collection.find({"leader_id": ""}).explain()["queryPlanner"]["winningPlan"],
+        "tokens by session_id": spotify_token_collection.find({"session_id": ""}).explain()["queryPlanner"]["winningPlan"],
+    }
+
+
+# Return a page of this user's squads, oldest first, with just the fields the
+# squad list shows, and the cursor of the next page, or None if this is the last page
+# Pass the cursor as after to get the next page
+@mongo_operation_seconds.timed
+def get_user_squad_list(spotify_api, after=None):
+    query = {"leader_id": spotify_api.me()["id"]}
+    if after is not None and ObjectId.is_valid(after):
+        query["_id"] = {"$gt": ObjectId(after)}
+
+    squads = list(
+        squads_collection.find(query, {"squad_id": True, "squad_name": True})
+        .sort("_id", ASCENDING)
+        .limit(SQUADS_PAGE_SIZE + 1)
+    )
+    if len(squads) <= SQUADS_PAGE_SIZE:
+        return squads, None
+    return squads[:SQUADS_PAGE_SIZE], str(squads[SQUADS_PAGE_SIZE - 1]["_id"])
+
+
+@mongo_operation_seconds.timed
 def insert_squad(squad_id, squad_name, spotify_api):
+    leader = spotify_api.me()
     squads_collection.insert_one(
         dict(
             squad_id=squad_id,
             squad_name=squad_name,
-            leader_id=spotify_api.me()["id"],
-            leader_name=spotify_api.me()["display_name"],
+            leader_id=leader["id"],
+            leader_name=leader["display_name"],
             playlists=[],
+            collabs=[],  # The collab playlist made for each user that has compiled this squad
+            version=1,  # Bumped whenever anything the squad page shows changes
+            modified_at=datetime.utcnow(),
         )
     )
 
 
+@mongo_operation_seconds.timed
 def delete_squad(squad):
     squads_collection.delete_one({"squad_id": squad["squad_id"]})
+    squad_tracks_collection.delete_many({"squad_id": squad["squad_id"]})
+    indexed_playlists_collection.delete_many({"squad_id": squad["squad_id"]})
 
 
+@mongo_operation_seconds.timed
 def add_playlist_to_squad(squad_id, playlist_id, user_name):
     squads_collection.update_one(
         {"squad_id": squad_id},
@@ -40,11 +236,14 @@ def add_playlist_to_squad(squad_id, playlist_id, user_name):
                     "playlist_id": playlist_id,
                     "user_name": user_name,
                 }
-            }
+            },
+            "$inc": {"version": 1},
+            "$set": {"modified_at": datetime.utcnow()},
         },
     )
 
 
+@mongo_operation_seconds.timed
 def delete_playlist_from_squad(squad_id, playlist_id, user_name):
     squads_collection.update_one(
         {"squad_id": squad_id},
@@ -54,49 +253,521 @@ def delete_playlist_from_squad(squad_id, playlist_id, user_name):
                     "playlist_id": playlist_id,
                     "user_name": user_name,
                 }
+            },
+            "$inc": {"version": 1},
+            "$set": {"modified_at": datetime.utcnow()},
+        },
+    )
+
+
+# Return the ID of the collab playlist last compiled for this user from this
+# squad, or None if they've never compiled it
+def get_squad_collab_id(squad, user_id):
+    for collab in squad.get("collabs", []):
+        if collab["user_id"] == user_id:
+            return collab["playlist_id"]
+    return None
+
+
+@mongo_operation_seconds.timed
+def set_squad_collab_id(squad_id, user_id, playlist_id):
+    squads_collection.update_one({"squad_id": squad_id}, {"$pull": {"collabs": {"user_id": user_id}}})
+    squads_collection.update_one(
+        {"squad_id": squad_id},
+        {
+            "$push": {
+                "collabs": {
+                    "user_id": user_id,
+                    "playlist_id": playlist_id,
+                }
             }
         },
     )
 
 
+@mongo_operation_seconds.timed
+def insert_job(job_id, squad_id, status, num_playlists, seed):
+    now = datetime.utcnow()
+    jobs_collection.insert_one(
+        dict(
+            job_id=job_id,
+            squad_id=squad_id,
+            status=status,
+            seed=seed,
+            playlists_total=num_playlists,
+            playlists_fetched=0,
+            tracks_total=0,
+            tracks_pushed=0,
+            collab_id=None,
+            skipped_playlists=[],
+            variants=[],  # Each collab built, as its seed and tracks
+            variant=0,  # Which of them is in the collab playlist
+            created_at=now,
+            updated_at=now,  # Every change to a job updates this, so a job nobody's working on can be told apart
+        )
+    )
+
+
+@mongo_operation_seconds.timed
+def update_job(job_id, **fields):
+    jobs_collection.update_one({"job_id": job_id}, {"$set": dict(fields, updated_at=datetime.utcnow())})
+
+
+# Add to the job's counters, for instance playlists_fetched=1
+@mongo_operation_seconds.timed
+def increment_job(job_id, **counters):
+    jobs_collection.update_one({"job_id": job_id}, {"$inc": counters, "$set": {"updated_at": datetime.utcnow()}})
+
+
+# Update a job only if it's in one of the given statuses and hasn't been updated
+# since updated_before, so a job that made progress in the meantime is left alone
+# Returns whether it was updated
+@mongo_operation_seconds.timed
+def update_stale_job(job_id, statuses, updated_before, **fields):
+    result = jobs_collection.update_one(
+        {"job_id": job_id, "status": {"$in": statuses}, "updated_at": {"$lt": updated_before}},
+        {"$set": dict(fields, updated_at=datetime.utcnow())},
+    )
+    return result.modified_count > 0
+
+
+@mongo_operation_seconds.timed
+def get_job(job_id):
+    return jobs_collection.find_one({"job_id": job_id}, {"_id": False})
+
+
+# The squad's track index has a document in squad_tracks for each track in the
+# squad's playlists, holding the playlists that have it, the members who own it
+# and its frequency, plus a document in indexed_playlists for each playlist
+# holding the snapshot ID it was indexed at
+# A track's _id is made of the squad ID and its track_index_key, so the _id index
+# keeps a squad from having two documents for the same track
+# Playlists are added and removed with targeted updates to just their tracks, so
+# no document grows with the size of the squad
+
+# Return a dictionary of the snapshot ID each (playlist ID, member) in the
+# squad's track index was indexed at
+@mongo_operation_seconds.timed
+def get_indexed_snapshots(squad_id):
+    documents = indexed_playlists_collection.find({"squad_id": squad_id}, {"_id": False, "squad_id": False})
+    return {(document["playlist_id"], document["user_name"]): document["snapshot_id"] for document in documents}
+
+
+# Return a dictionary mapping each track owned by at least MIN_FREQUENCY of the
+# given members to the set of those members
+# Members the index has but who weren't given, like ones whose playlists another
+# compile just indexed, aren't counted
+@mongo_operation_seconds.timed
+def get_popular_tracks(squad_id, members):
+    members = set(members)
+    documents = squad_tracks_collection.find(
+        {"squad_id": squad_id, "frequency": {"$gte": MIN_FREQUENCY}}, {"_id": False, "squad_id": False}
+    )
+
+    popular_tracks = dict()
+    for document in documents:
+        members_of_track = members.intersection(document["members"])
+        if len(members_of_track) >= MIN_FREQUENCY:
+            popular_tracks[track_from_document(document)] = members_of_track
+    return popular_tracks
+
+
+# Given the snapshots the squad's track index had and the changes returned by
+# SpotifyAPI.get_playlist_changes, update the index to match
+# Playlists that aren't in the changes are removed, since they were removed from
+# the squad or can't be downloaded anymore
+# Returns whether the index changed
+def update_track_index(squad_id, snapshots, changes):
+    changed = False
+    current = set()
+    for member, playlist_id, snapshot_id, tracks in changes:
+        current.add((playlist_id, member))
+        if tracks is not None:
+            index_playlist(squad_id, playlist_id, member, snapshot_id, tracks)
+            changed = True
+    for playlist_id, member in snapshots.keys() - current:
+        remove_playlist_from_track_index(squad_id, playlist_id, member)
+        changed = True
+    return changed
+
+
+# Record the tracks a playlist has at the given snapshot ID in the squad's track
+# index, only touching the tracks that were added to or removed from the
+# playlist since it was last indexed
+@mongo_operation_seconds.timed
+def index_playlist(squad_id, playlist_id, member, snapshot_id, tracks):
+    owner = {"playlist_id": playlist_id, "user_name": member}
+    tracks = {track_index_key(track): track for track in tracks}
+    indexed = squad_tracks_collection.find({"squad_id": squad_id, "owners": {"$elemMatch": owner}}, {"_id": True})
+    indexed = set(document["_id"]["key"] for document in indexed)
+
+    removed = indexed - tracks.keys()
+    if removed:
+        remove_track_owner(squad_id, owner, removed)
+
+    added = {key: tracks[key] for key in tracks.keys() - indexed}
+    if added:
+        add_track_owner(squad_id, owner, added)
+
+    indexed_playlists_collection.update_one(
+        {"squad_id": squad_id, "playlist_id": playlist_id, "user_name": member},
+        {"$set": {"snapshot_id": snapshot_id}},
+        upsert=True,
+    )
+
+
+# Remove a playlist's tracks from the squad's track index
+@mongo_operation_seconds.timed
+def remove_playlist_from_track_index(squad_id, playlist_id, member):
+    remove_track_owner(squad_id, {"playlist_id": playlist_id, "user_name": member})
+    indexed_playlists_collection.delete_one({"squad_id": squad_id, "playlist_id": playlist_id, "user_name": member})
+
+
+# Add the owner (a playlist and the member who provided it) to the tracks in the
+# squad's track index, given as a dictionary from track_index_key to track,
+# inserting the tracks the index doesn't have yet, and count the member towards
+# the tracks they didn't own already
+def add_track_owner(squad_id, owner, tracks):
+    ids = [track_index_id(squad_id, key) for key in tracks]
+    existing = squad_tracks_collection.find({"_id": {"$in": ids}}, {"_id": True})
+    existing = set(document["_id"]["key"] for document in existing)
+
+    new_tracks = [
+        dict(
+            track_to_document(track),
+            _id=track_index_id(squad_id, key),
+            squad_id=squad_id,
+            owners=[owner],
+            members=[owner["user_name"]],
+            frequency=1,
+        )
+        for key, track in tracks.items()
+        if key not in existing
+    ]
+    if new_tracks:
+        try:
+            squad_tracks_collection.insert_many(new_tracks, ordered=False)
+        except BulkWriteError as e:
+            # Another compile inserted some of the same tracks at the same time,
+            # so those are updated like the ones that were already there
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            existing.update(new_tracks[error["index"]]["_id"]["key"] for error in e.details["writeErrors"])
+
+    if existing:
+        ids = [track_index_id(squad_id, key) for key in existing]
+        squad_tracks_collection.update_many({"_id": {"$in": ids}}, {"$addToSet": {"owners": owner}})
+        squad_tracks_collection.update_many(
+            {"_id": {"$in": ids}, "members": {"$ne": owner["user_name"]}},
+            {"$push": {"members": owner["user_name"]}, "$inc": {"frequency": 1}},
+        )
+
+
+# Remove the owner from the tracks in the squad's track index, or only from the
+# tracks with the given track_index_keys, and stop counting the member towards
+# the tracks none of their other playlists have
+# Tracks no one owns anymore are deleted
+def remove_track_owner(squad_id, owner, keys=None):
+    query = {"squad_id": squad_id, "owners": {"$elemMatch": owner}}
+    if keys is not None:
+        query["_id"] = {"$in": [track_index_id(squad_id, key) for key in keys]}
+
+    other_playlists = {"user_name": owner["user_name"], "playlist_id": {"$ne": owner["playlist_id"]}}
+    squad_tracks_collection.update_many(
+        dict(query, owners={"$elemMatch": owner, "$not": {"$elemMatch": other_playlists}}, members=owner["user_name"]),
+        {"$pull": {"members": owner["user_name"]}, "$inc": {"frequency": -1}},
+    )
+    squad_tracks_collection.update_many(query, {"$pull": {"owners": owner}})
+    squad_tracks_collection.delete_many({"squad_id": squad_id, "frequency": 0, "owners": {"$size": 0}})
+
+
+# Return a page of the squads that have playlists, in the order they were
+# created, with the fields compiling them needs, and the cursor of the next
+# page, or None if this is the last page
+# Pass the cursor as after to get the next page
+@mongo_operation_seconds.timed
+def get_squads_to_compile(after=None):
+    query = {"playlists.0": {"$exists": True}}
+    if after is not None:
+        query["_id"] = {"$gt": after}
+
+    squads = list(
+        squads_collection.find(query, {"squad_id": True, "squad_name": True, "playlists": True})
+        .sort("_id", ASCENDING)
+        .limit(COMPILE_PAGE_SIZE)
+    )
+    if len(squads) < COMPILE_PAGE_SIZE:
+        return squads, None
+    return squads, squads[-1]["_id"]
+
+
+# Store the collabs from compiling many squads in one bulk write, given as a
+# dictionary from squad ID to the squad's latest collab, which the squad page shows
+@mongo_operation_seconds.timed
+def save_compile_results(collabs):
+    if len(collabs) > 0:
+        squads_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"squad_id": squad_id},
+                    {"$set": {"latest_collab": collab, "modified_at": datetime.utcnow()}, "$inc": {"version": 1}},
+                )
+                for squad_id, collab in collabs.items()
+            ],
+            ordered=False,
+        )
+
+
 # Get a CacheHandler that stores this user's Spotify auth token
 def spotify_cache_handler():
     session["uuid"] = session.get("uuid", str(uuid.uuid4())) # Ensure the user has a Flask session ID
     return MongoCacheHandler(session["uuid"])
 
 
-# Caches Spotify auth tokens in a MongoDB collection
+# Caches Spotify auth tokens in a MongoDB collection, with an in-process cache
+# in front of it so most requests don't have to query MongoDB
+# Each session's document holds its token_info and the user_profile of its user
 class MongoCacheHandler(CacheHandler):
 
     def __init__(self, session_id):
         self.session_id = session_id
 
     def get_cached_token(self):
-        document = spotify_token_collection.find_one({"session_id": self.session_id})
+        document = self.__get_document()
         return document["token_info"] if document else None
 
+    @mongo_operation_seconds.timed
     def save_token_to_cache(self, token_info):
-        spotify_token_collection.insert_one(
-            dict(
-                session_id=self.session_id,
-                token_info=token_info,
-            )
+        spotify_token_collection.update_one(
+            {"session_id": self.session_id},
+            {"$set": {"token_info": token_info, "expire_at": datetime.utcnow() + TOKEN_RETENTION}},
+            upsert=True,
         )
+        document = self.__get_document() or {}
+        self.__cache_document(dict(document, token_info=token_info))
+        invalidate_cached_token(self.session_id)
 
+    # The user's profile is kept with their token, so it's forgotten when they sign out
+    def get_cached_profile(self):
+        document = self.__get_document()
+        return document.get("user_profile") if document else None
+
+    @mongo_operation_seconds.timed
+    def save_profile_to_cache(self, profile):
+        spotify_token_collection.update_many({"session_id": self.session_id}, {"$set": {"user_profile": profile}})
+        document = self.__get_document()
+        if document:
+            self.__cache_document(dict(document, user_profile=profile))
+
+    @mongo_operation_seconds.timed
     def delete_token_from_cache(self):
         # Should only need to delete one, but duplicate tokens have been found
         # during development
         spotify_token_collection.delete_many({"session_id": self.session_id})
+        self.__cache_document(None)
+        invalidate_cached_token(self.session_id)
+
+    # Return this session's document, or None if it has no token
+    def __get_document(self):
+        poll_token_invalidations()
+        document = token_cache.get(self.session_id)
+        if document is MISSING:
+            with mongo_operation_seconds.time(operation="MongoCacheHandler.get_document"):
+                document = spotify_token_collection.find_one(
+                    {"session_id": self.session_id},
+                    {"_id": False, "token_info": True, "user_profile": True},
+                )
+            self.__cache_document(document)
+        return document
+
+    # Cache this session's document, or forget it if it has none
+    # A missing token isn't cached, since a user who just signed in on another
+    # worker would otherwise be treated as signed out here until the next poll
+    # A token leaves the cache when it expires, so if another worker has already
+    # refreshed it, we pick up the new token instead of refreshing it again
+    def __cache_document(self, document):
+        if document is None:
+            token_cache.delete(self.session_id)
+        else:
+            token_cache.set(self.session_id, document, document["token_info"].get("expires_at"))
+
+
+# Keeps a Spotify auth token in memory for as long as this handler is used,
+# for things like commands that only need a token while they run
+class MemoryCacheHandler(CacheHandler):
+
+    def __init__(self, token_info=None):
+        self.token_info = token_info
+
+    def get_cached_token(self):
+        return self.token_info
+
+    def save_token_to_cache(self, token_info):
+        self.token_info = token_info
+
+
+# Tell every worker to drop its cached copy of this session's token the next
+# time it polls, because the token changed or the user signed out
+@mongo_operation_seconds.timed
+def invalidate_cached_token(session_id):
+    token_invalidations_collection.insert_one(dict(session_id=session_id, invalidated_at=datetime.utcnow()))
+
+
+# Drop the cached tokens other workers have invalidated since the last poll
+# Polls at most once per TOKEN_INVALIDATION_POLL_INTERVAL, so this costs one
+# query per interval per worker instead of one per request
+def poll_token_invalidations():
+    global last_token_invalidation_poll
+
+    now = time.time()
+    if now < last_token_invalidation_poll + TOKEN_INVALIDATION_POLL_INTERVAL:
+        return
+    since = datetime.utcfromtimestamp(last_token_invalidation_poll - TOKEN_INVALIDATION_CLOCK_SKEW)
+    last_token_invalidation_poll = now
+
+    with mongo_operation_seconds.time(operation="poll_token_invalidations"):
+        invalidations = token_invalidations_collection.find({"invalidated_at": {"$gt": since}}, {"session_id": True})
+        for invalidation in invalidations:
+            token_cache.delete(invalidation["session_id"])
+
+
+# Caches the track lists of playlists in a MongoDB collection
+# Each entry is keyed by the playlist's Spotify snapshot ID, which changes
+# whenever the playlist does, so a cached track list is never stale
+class MongoTrackCache:
+
+    # Return the cached tracks of this version of the playlist, or None if it isn't cached
+    @mongo_operation_seconds.timed
+    def get_cached_tracks(self, playlist_id, snapshot_id):
+        now = datetime.utcnow()
+        document = playlist_cache_collection.find_one_and_update(
+            {
+                "playlist_id": playlist_id,
+                "snapshot_id": snapshot_id,
+                "last_used": {"$gt": now - PLAYLIST_CACHE_TTL},
+            },
+            {"$set": {"last_used": now}},
+            projection={"tracks": True},
+        )
+        return [track_from_document(track) for track in document["tracks"]] if document else None
+
+    # Replace the cached tracks of the playlist with this version of it
+    @mongo_operation_seconds.timed
+    def save_tracks_to_cache(self, playlist_id, snapshot_id, tracks):
+        document = dict(
+            playlist_id=playlist_id,
+            snapshot_id=snapshot_id,
+            tracks=[track_to_document(track) for track in tracks],
+            last_used=datetime.utcnow(),
+        )
+        try:
+            playlist_cache_collection.replace_one({"playlist_id": playlist_id}, document, upsert=True)
+        except DuplicateKeyError:
+            # Another compile fetched the same playlist and inserted it first
+            playlist_cache_collection.replace_one({"playlist_id": playlist_id}, document)
+        self.__evict()
+
+    # Remove expired playlists, then the least recently used ones until the cache
+    # is back under its max size
+    def __evict(self):
+        playlist_cache_collection.delete_many({"last_used": {"$lte": datetime.utcnow() - PLAYLIST_CACHE_TTL}})
+
+        num_over = playlist_cache_collection.estimated_document_count() - PLAYLIST_CACHE_MAX_ENTRIES
+        if num_over > 0:
+            oldest = playlist_cache_collection.find({}, {"_id": True}).sort("last_used", ASCENDING).limit(num_over)
+            playlist_cache_collection.delete_many({"_id": {"$in": [document["_id"] for document in oldest]}})
+
+
+# Remembers the last time each user's Liked Songs were copied to a playlist
+class MongoLikedSongsSync:
+
+    # Return the user's last sync as a dictionary with their Liked Songs playlist_id,
+    # the last_added_at time of their newest liked song, and their track_count,
+    # or None if they've never synced
+    @mongo_operation_seconds.timed
+    def get_sync_marker(self, user_id):
+        return liked_songs_collection.find_one({"user_id": user_id})
+
+    @mongo_operation_seconds.timed
+    def save_sync_marker(self, user_id, playlist_id, last_added_at, track_count):
+        liked_songs_collection.replace_one(
+            {"user_id": user_id},
+            dict(
+                user_id=user_id,
+                playlist_id=playlist_id,
+                last_added_at=last_added_at,
+                track_count=track_count,
+            ),
+            upsert=True,
+        )
+
+
+# Store only the fields of a track that building a collab needs
+def track_to_document(track):
+    return dict(id=track.id, name=track.title, artists=list(track.artists))
+
+
+# Tracks with the same title and artists are the same track, so they share a
+# key in the squad track index
+def track_index_key(track):
+    return "\x1f".join([track.title, *sorted(track.artists)])
+
+
+# The _id of a track's document in the squad track index, given its key
+def track_index_id(squad_id, key):
+    return {"squad_id": squad_id, "key": key}
+
+
+def track_from_document(document):
+    return Track(
+        dict(
+            id=document["id"],
+            name=document["name"],
+            artists=[dict(name=artist) for artist in document["artists"]],
+        )
+    )
+
+
+# A squad whose fields are fetched from MongoDB when they're first used, fetching
+# only those fields instead of the whole document
+# Use load() to fetch several fields in one query before using them
+# Returns a 404 once a field is fetched if the squad doesn't exist
+class LazySquad:
+
+    def __init__(self, squad_id):
+        self.squad_id = squad_id
+        self.fields = dict(squad_id=squad_id)
+        self.found = False  # Whether we've checked that the squad exists
+
+    # Fetch the given fields if they haven't been already, and make sure the squad exists
+    def load(self, *field_names):
+        missing = [field_name for field_name in field_names if field_name not in self.fields]
+        if missing or not self.found:
+            projection = dict.fromkeys(missing, True)
+            projection.update(_id=False, squad_id=True)
+            with mongo_operation_seconds.time(operation="LazySquad.load"):
+                document = squads_collection.find_one({"squad_id": self.squad_id}, projection)
+            if document is None:
+                abort(404)
+            self.found = True
+            for field_name in missing:
+                self.fields[field_name] = document.get(field_name)
+        return self
+
+    def __getitem__(self, field_name):
+        self.load(field_name)
+        return self.fields[field_name]
+
+    def get(self, field_name, default=None):
+        value = self[field_name]
+        return default if value is None else value
 
 
-# Fetches a squad from a squad_id, or returns a 404 if it doesn't exist
+# Turns a squad_id in a URL into a LazySquad
 class SquadConverter(BaseConverter):
 
     def to_python(self, squad_id):
-        squad = squads_collection.find_one({"squad_id": squad_id})
-        if squad == None:
-            abort(404)
-        return squad
+        return LazySquad(squad_id)
 
     def to_url(self, squad):
         return squad["squad_id"]
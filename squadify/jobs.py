@@ -0,0 +1,184 @@
+import logging
+import os
+import random
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from .make_collab import builder_from_track_members
+from . import database
+
+
+COMPILE_WORKERS = 4  # Max number of squads each process compiles at once
+COLLAB_VARIANTS = 3  # Number of collabs built by each compile for the user to choose from
+JOB_STALE_AFTER = timedelta(minutes=5)  # A running job that hasn't been updated for this long is reported as failed
+
+# Stages of a compile job, in order, plus failure
+JOB_FETCHING = "fetching"  # Downloading the squad's playlists
+JOB_BUILDING = "building"  # Building the collab
+JOB_PUSHING = "pushing"  # Writing the collab's tracks to the user's collab playlist
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+# Compiles run here instead of in the request, so a large squad can't hit the
+# worker timeout or hold up other users' requests
+# Created on first use so that each worker process gets its own
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=COMPILE_WORKERS)
+    return executor
+
+
+# A forked worker can't use its parent's threads
+def forget_executor_after_fork():
+    global executor, executor_lock
+    executor = None
+    executor_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=forget_executor_after_fork)
+
+
+# Start compiling a squad in the background
+# The collabs it builds are decided by the seed, so compiling an unchanged squad
+# with the same seed gives the same collabs; without one, a random seed is picked
+# Returns the job ID, which can be used to check on the job's progress
+def start_compile_job(spotify_api, squad, seed=None):
+    job_id = str(uuid.uuid4())
+    seed = random.randrange(2**32) if seed is None else seed
+    database.insert_job(job_id, squad["squad_id"], JOB_FETCHING, len(squad["playlists"]), seed)
+    get_executor().submit(run_compile_job, job_id, spotify_api, squad, seed)
+    return job_id
+
+
+# Start writing the collab that compile-all last built for a squad to the user's
+# collab playlist in the background, without downloading or building anything
+# Returns the job ID, like start_compile_job
+def start_latest_collab_job(spotify_api, squad):
+    job_id = str(uuid.uuid4())
+    latest_collab = squad["latest_collab"]
+    database.insert_job(job_id, squad["squad_id"], JOB_PUSHING, len(squad["playlists"]), latest_collab["seed"])
+    database.update_job(
+        job_id,
+        playlists_fetched=len(squad["playlists"]),
+        tracks_total=len(latest_collab["tracks"]),
+        variants=[dict(seed=latest_collab["seed"], tracks=latest_collab["tracks"])],
+    )
+    get_executor().submit(run_latest_collab_job, job_id, spotify_api, squad)
+    return job_id
+
+
+def run_latest_collab_job(job_id, spotify_api, squad):
+    try:
+        collab = [database.track_from_document(track) for track in squad["latest_collab"]["tracks"]]
+        on_pushed = lambda count: database.increment_job(job_id, tracks_pushed=count)
+        collab_id = push_collab(spotify_api, squad, collab, on_pushed)
+        database.update_job(job_id, status=JOB_DONE, collab_id=collab_id)
+    except Exception:
+        logging.exception(f"Compile job {job_id} failed")
+        database.update_job(job_id, status=JOB_FAILED)
+
+
+# Return a job's document, or None if there's no such job
+# Jobs only live in the thread pool of the process that started them, so one
+# whose process was restarted would otherwise stay unfinished until it expired;
+# a job that hasn't been updated for JOB_STALE_AFTER is failed instead
+def get_job(job_id):
+    job = database.get_job(job_id)
+    if job is None or job["status"] in (JOB_DONE, JOB_FAILED):
+        return job
+
+    updated_before = datetime.utcnow() - JOB_STALE_AFTER
+    if job["updated_at"] < updated_before:
+        running = [JOB_FETCHING, JOB_BUILDING, JOB_PUSHING]
+        if database.update_stale_job(job_id, running, updated_before, status=JOB_FAILED):
+            logging.warning(f"Compile job {job_id} stopped making progress and was marked as failed")
+        job = database.get_job(job_id)
+    return job
+
+
+# Create a collab out of a squad, recording progress in the job's document
+# Only the playlists that changed since the squad's track index was last updated
+# are downloaded; the rest of the collab is built from the index
+# COLLAB_VARIANTS collabs are built from the seed and kept in the job, and the
+# first one is written to the user's collab playlist
+def run_compile_job(job_id, spotify_api, squad, seed):
+    try:
+        popular_tracks, _, members, skipped_playlists = refresh_track_index(
+            spotify_api, squad, on_fetched=lambda: database.increment_job(job_id, playlists_fetched=1)
+        )
+        database.update_job(job_id, skipped_playlists=skipped_playlists)
+
+        # Give up if the squad has no valid playlists
+        if len(members) == 0:
+            database.update_job(job_id, status=JOB_FAILED)
+            return
+
+        # Build several collaborative playlists from this squad's popular tracks
+        database.update_job(job_id, status=JOB_BUILDING)
+        seeds = [seed + i for i in range(COLLAB_VARIANTS)]
+        collabs = builder_from_track_members(members, popular_tracks).build_variants(seeds)
+        database.update_job(
+            job_id,
+            variants=[
+                dict(seed=variant_seed, tracks=[database.track_to_document(track) for track in collab])
+                for variant_seed, collab in zip(seeds, collabs)
+            ],
+        )
+
+        database.update_job(job_id, status=JOB_PUSHING, tracks_total=len(collabs[0]))
+        on_pushed = lambda count: database.increment_job(job_id, tracks_pushed=count)
+        collab_id = push_collab(spotify_api, squad, collabs[0], on_pushed)
+
+        database.update_job(job_id, status=JOB_DONE, collab_id=collab_id)
+    except Exception:
+        logging.exception(f"Compile job {job_id} failed")
+        database.update_job(job_id, status=JOB_FAILED)
+
+
+# Check all of a squad's playlists at once against its track index, setting
+# aside the ones that can't be downloaded, and bring the index up to date with
+# the playlists that were added, removed or changed
+# The index is left alone if none of the playlists could be downloaded
+# Returns the squad's popular tracks, as a dictionary mapping each one to the set
+# of members who own it, whether the index changed, the member of each playlist
+# that could be downloaded, and a list of (member, playlist ID, reason) for the
+# playlists that couldn't
+def refresh_track_index(spotify_api, squad, on_fetched=None):
+    snapshots = database.get_indexed_snapshots(squad["squad_id"])
+    playlists = list(dict.fromkeys((playlist["user_name"], playlist["playlist_id"]) for playlist in squad["playlists"]))
+    changes, skipped_playlists = spotify_api.get_playlist_changes(playlists, snapshots, on_fetched=on_fetched)
+    if len(changes) == 0:
+        return dict(), False, [], skipped_playlists
+
+    changed = database.update_track_index(squad["squad_id"], snapshots, changes)
+    members = [member for member, _, _, _ in changes]
+    return database.get_popular_tracks(squad["squad_id"], members), changed, members, skipped_playlists
+
+
+# Write one of a finished job's other collabs to the user's collab playlist
+# Returns the ID of the playlist
+def use_variant(spotify_api, squad, job, variant):
+    collab = [database.track_from_document(track) for track in job["variants"][variant]["tracks"]]
+    collab_id = push_collab(spotify_api, squad, collab)
+    database.update_job(job["job_id"], variant=variant, collab_id=collab_id)
+    return collab_id
+
+
+# Update the playlist this user got from the last compile to contain the collab,
+# or make one if they don't have one yet
+# Returns the ID of the playlist
+def push_collab(spotify_api, squad, collab, on_pushed=None):
+    user_id = spotify_api.current_user()["id"]
+    collab_id = database.get_squad_collab_id(squad, user_id)
+    if collab_id is None or not spotify_api.replace_playlist_tracks(collab_id, collab, on_pushed):
+        collab_id = spotify_api.create_playlist_with_tracks(squad["squad_name"], collab, on_pushed)
+        database.set_squad_collab_id(squad["squad_id"], user_id, collab_id)
+    return collab_id
@@ -1,5 +1,10 @@
+import heapq
 import random
+import sys
+from array import array
+from bisect import bisect_left
 from collections import Counter
+from .metrics import collab_build_seconds
 
 
 # Arbitrary max collab size we impose
@@ -12,24 +17,38 @@ MIN_SHARE_FACTOR = 0.5
 # Only add a track to the collab if it has at least this frequency
 MIN_FREQUENCY = 2
 
+# Squads with at least this many members are built with BitsetCollabBuilder
+BITSET_ENGINE_MIN_MEMBERS = 20
+
 
 # Points to a previous and next track
 class Node:
+    __slots__ = ("prev", "next")
+
     def __init__(self):
         self.prev = None
         self.next = None
 
 
 # A single track
+# Squads can have tens of thousands of tracks, so tracks are kept compact: no
+# per-instance __dict__, artist names shared between tracks, and a hash computed
+# once instead of on every dict/set lookup
 class Track:
+    __slots__ = ("title", "artists", "id", "key", "hash", "members")
+
     def __init__(self, track):
         self.title = track["name"]
-        self.artists = frozenset([artist["name"] for artist in track["artists"]])
+        self.artists = frozenset([sys.intern(artist["name"]) for artist in track["artists"]])
         self.id = track["id"]
-        self.members = {None: Node()}  # Dummy member that owns all tracks
+        self.key = (self.title, self.artists)  # Tracks with the same title and artists are the same track
+        self.hash = hash(self.key)
+        self.members = None  # Created when the first member is added
 
     # Record that this track is owned by another member
     def add_member(self, member):
+        if self.members is None:
+            self.members = {None: Node()}  # Dummy member that owns all tracks
         self.members[member] = Node()
 
     # Return the number of members that own this track
@@ -52,11 +71,16 @@ class Track:
     def set_prev(self, member, track):
         self.members[member].prev = track
 
+    # Return a key that puts tracks in the same order no matter which playlists
+    # they came from or in what order
+    def sort_key(self):
+        return (self.title, sorted(self.artists))
+
     def __hash__(self):
-        return hash((self.title, self.artists))
+        return self.hash
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        return isinstance(other, Track) and self.hash == other.hash and self.key == other.key
 
     def __str__(self):
         return self.title + " - " + ", ".join(self.artists)
@@ -70,18 +94,31 @@ class Playlist:
 
 
 class CollabBuilder:
-    def __init__(self, playlists):
+    def __init__(self, playlists, max_collab_size=MAX_COLLAB_SIZE, seed=None):
         # Dictionary mapping a member name to a playlist of tracks
         self.playlists = playlists
 
+        # Max number of tracks in the collab
+        self.max_collab_size = max_collab_size
+
+        # Seed that decides how ties between tracks are broken, so the same seed
+        # always gives the same collab; None for a different collab each time
+        self.seed = seed
+        self.random = random.Random(seed)
+
         # The collaborative playlist we're building
         self.collab = []
 
-        # All the tracks from all the playlists
+        # All the tracks from all the playlists, in the order of the collab being built
         self.tracks = []
 
-        # Names of all the squad members
-        self.members = set({None})
+        # The same tracks in sort_key order, worked out on the first build, which
+        # each collab shuffles its own way
+        self.tracks_by_key = None
+
+        # Names of all the squad members, in the order they joined
+        # A dict is used as an ordered set so ties between members break the same way every time
+        self.members = dict.fromkeys([None])
 
         # Number of unadded tracks at each frequency
         self.num_tracks_left_for_freq = None
@@ -92,32 +129,58 @@ class CollabBuilder:
         # Each member's most popular track
         self.most_popular_track_of_member = None
 
-    # Return a list of all tracks from the playlists (sorted from most to least
-    # popular), list of all the members, and a dictionary containing the number of
-    # tracks at each frequency level. Each track is also labeled with which members
-    # own it.
+        # Dictionary mapping each track to the set of members who own it, either
+        # given to the builder or worked out from the playlists on the first build
+        self.track_members = None
+
+    # Return a builder for tracks whose owners were already worked out, like a
+    # squad's popular tracks from its track index, instead of for playlists
+    # members lists every member in the order they joined, since some may not own
+    # any of the given tracks
+    @staticmethod
+    def from_track_members(members, track_members, max_collab_size=MAX_COLLAB_SIZE, seed=None):
+        builder = CollabBuilder([], max_collab_size, seed)
+        builder.members.update(dict.fromkeys(members))
+        builder.track_members = track_members
+        return builder
+
+    # Make a list of all tracks from the playlists in an order that doesn't depend
+    # on the order of the playlists, and a list of all the members. Each track is
+    # also labeled with which members own it.
     def __create_track_list(self):
-        # For each track, create a set of the members who own it
-        tracks_to_members = dict()
-        for playlist in self.playlists:
-            self.members.add(playlist.member)
-            for track in playlist.tracks:
-                members_of_track = tracks_to_members.setdefault(track, set())
-                members_of_track.add(playlist.member)
-                tracks_to_members[track] = members_of_track
-
-        # Move those members from the dictionary into each track object
-        # and create the track list
-        for track, members_of_track in tracks_to_members.items():
+        # For each track, create a set of the members who own it, unless we already have them
+        if self.track_members is None:
+            tracks_to_members = dict()
+            for playlist in self.playlists:
+                self.members.setdefault(playlist.member)
+                for track in playlist.tracks:
+                    members_of_track = tracks_to_members.get(track)
+                    if members_of_track is None:
+                        tracks_to_members[track] = members_of_track = set()
+                    members_of_track.add(playlist.member)
+            self.track_members = tracks_to_members
+
+        # Move those members from the dictionary into each track object and create
+        # the track list, eliminating tracks below the minimum frequency
+        self.tracks_by_key = []
+        for track, members_of_track in self.track_members.items():
+            if len(members_of_track) < MIN_FREQUENCY:
+                continue
+            track.members = None  # Forget the members of any previous builder
             for member in members_of_track:
                 track.add_member(member)
-            self.tracks.append(track)
-
-        # Eliminate tracks below the minimum frequency
-        self.tracks = list(filter(lambda track: track.frequency() >= MIN_FREQUENCY, self.tracks))
-
-        # Get a slightly different collab each time it's compiled
-        random.shuffle(self.tracks)
+            self.tracks_by_key.append(track)
+        self.tracks_by_key.sort(key=Track.sort_key)
+        self.tracks = list(self.tracks_by_key)
+
+    # Sort the tracks from most to least popular for a new collab, with ties
+    # broken by the given seed, and reset the counts of the tracks left at each
+    # frequency level and the tracks added for each member
+    def __shuffle(self, seed):
+        self.random = random.Random(seed)
+        self.collab = []
+        self.tracks = list(self.tracks_by_key)
+        self.random.shuffle(self.tracks)
 
         # Sort the tracks by frequency (number of members owning it)
         self.tracks.sort(key=Track.frequency, reverse=True)
@@ -152,16 +215,22 @@ class CollabBuilder:
                 # Update the previous track
                 prev_track_of_member[member] = track
 
+        # Each member's last track has no next, even if it had one in an earlier collab
+        for member, track in prev_track_of_member.items():
+            if track is not None:
+                track.set_next(member, None)
+
     # Add track to the collab and remove it from the track list
     def __consume_track(self, track):
         # Add the track to the collab
         self.collab.append(track)
 
         # This track's frequency now has one less track
-        self.num_tracks_left_for_freq[track.frequency()] -= 1
-
         # It might have no tracks left now; if so, remove it from the dict
-        self.num_tracks_left_for_freq = +self.num_tracks_left_for_freq
+        frequency = track.frequency()
+        self.num_tracks_left_for_freq[frequency] -= 1
+        if self.num_tracks_left_for_freq[frequency] == 0:
+            del self.num_tracks_left_for_freq[frequency]
 
         # Update linkedness for each member
         for member in track.members:
@@ -206,7 +275,7 @@ class CollabBuilder:
         count_of_highest_freq = self.num_tracks_left_for_freq[self.__get_highest_frequency()]
 
         # Adding all of the tracks would put us over the limit
-        if count_of_highest_freq + len(self.collab) > MAX_COLLAB_SIZE:
+        if count_of_highest_freq + len(self.collab) > self.max_collab_size:
             return False
 
         # Consume all tracks in the highest frequency level
@@ -235,7 +304,7 @@ class CollabBuilder:
     # Make sure each member reaches a minimum threshold of tracks in the collab
     # Give up on a member if they don't have enough tracks to reach the threshold
     def __give_members_minimum_share(self):
-        min_tracks_per_member = int(MAX_COLLAB_SIZE / self.__get_number_of_members() * MIN_SHARE_FACTOR)
+        min_tracks_per_member = int(self.max_collab_size / self.__get_number_of_members() * MIN_SHARE_FACTOR)
         for member in self.members:
             num_tracks_needed = min_tracks_per_member - self.num_tracks_added_for_member[member]
             for i in range(num_tracks_needed):
@@ -258,15 +327,21 @@ class CollabBuilder:
         # The highest frequency with tracks remaining
         last_frequency = self.__get_highest_frequency()
 
-        # Filter for only members with tracks at the highest frequency
-        filtered_members = self.members.copy()
+        # Min-heap of (tracks added, join order, member) for members that may still
+        # have tracks at the highest frequency
+        # Entries go stale when a member gets more tracks added, so they're
+        # refreshed when they reach the top instead of on every track
+        heap = [(self.num_tracks_added_for_member[member], i, member) for i, member in enumerate(self.members)]
+        heapq.heapify(heap)
 
         # Iterate until the collab has reached its max size
-        while len(self.collab) < MAX_COLLAB_SIZE:
+        while len(self.collab) < self.max_collab_size and heap:
 
             # Find the member with the fewest tracks added to the collab
-            filtered_track_counts = {member: self.num_tracks_added_for_member[member] for member in filtered_members}
-            least_popular_member = min(filtered_track_counts, key=filtered_track_counts.get)
+            num_tracks_added, i, least_popular_member = heap[0]
+            if num_tracks_added != self.num_tracks_added_for_member[least_popular_member]:
+                heapq.heapreplace(heap, (self.num_tracks_added_for_member[least_popular_member], i, least_popular_member))
+                continue
 
             # Get that member's most popular track
             track = self.most_popular_track_of_member[least_popular_member]
@@ -274,20 +349,321 @@ class CollabBuilder:
             # If that member has no tracks left or the track is not in the
             # highest frequency level, remove this member from consideration
             if track == None or track.frequency() < last_frequency:
-                filtered_members.remove(least_popular_member)
+                heapq.heappop(heap)
                 continue
 
             # Otherwise, consume the track
             self.__consume_track(track)
 
     # Make a collaborative playlist (collab) out of the playlists of each squad member
+    # Each phase is timed separately
     def build(self):
-        self.__create_track_list()
-        self.__link_tracks()
-        self.__give_members_minimum_share()
-        self.__add_all_of_highest_frequencies()
-        self.__add_some_of_last_frequency()
+        return self.build_variants([self.seed])[0]
+
+    # Make one collab for each of the given seeds
+    # The track list and each track's members are only made once, so each extra
+    # collab only costs reordering and relinking the tracks and choosing from them
+    def build_variants(self, seeds):
+        if self.tracks_by_key is None:
+            with collab_build_seconds.time(phase="create_track_list"):
+                self.__create_track_list()
+
+        collabs = []
+        for seed in seeds:
+            self.__shuffle(seed)
+            with collab_build_seconds.time(phase="link_tracks"):
+                self.__link_tracks()
+            with collab_build_seconds.time(phase="minimum_share"):
+                self.__give_members_minimum_share()
+            with collab_build_seconds.time(phase="highest_frequencies"):
+                self.__add_all_of_highest_frequencies()
+            with collab_build_seconds.time(phase="last_frequency"):
+                self.__add_some_of_last_frequency()
+
+            self.collab.sort(key=Track.frequency, reverse=True)
+            collabs.append(self.collab)
+
+        return collabs
+
+
+# Builds the same collab as CollabBuilder, using far less memory for squads with
+# many members
+# Instead of a linked list node for every member of every track, each track's
+# owners are an int used as a bitset of member numbers, and each member's tracks
+# are an array of track ranks
+# Tracks are ranked once by frequency, and each seed only reorders tracks within
+# a frequency, so several collabs can share that work and only repeat the choosing
+class BitsetCollabBuilder:
+    def __init__(self, playlists, max_collab_size=MAX_COLLAB_SIZE, seed=None):
+        self.playlists = playlists
+        self.max_collab_size = max_collab_size
+        self.seed = seed
+
+        # Names of all the squad members, in the order they joined, with the dummy
+        # member that owns all tracks first
+        # A member's number is their position in this list
+        self.members = [None]
+
+        # Dictionary mapping each track to the set of members who own it, if the
+        # builder was given that instead of playlists
+        self.track_members = None
+
+        # The tracks from most to least popular, with ties in sort_key order; a
+        # track's rank is its position here
+        self.tracks = None
+
+        # Bitset of the members who own each track, by rank
+        self.owners = None
+
+        # Number of members who own each track, by rank
+        self.frequencies = None
+
+        # Ranks in sort_key order, which each seed shuffles
+        self.ranks_by_key = None
+
+        # First rank with each frequency, and the rank after the last one
+        self.first_rank_of_freq = dict()
+        self.end_rank_of_freq = dict()
+
+        # Ranks of the tracks each member owns, in order, by member number
+        self.tracks_of_member = None
+
+        # The rest is reset for each collab
+
+        # Ranks from most to least popular, with ties broken by the seed
+        self.order = None
+
+        # Position of each rank in order
+        self.position = None
+
+        # Whether each track has been added to the collab, by rank
+        self.added = None
+
+        # The tracks of each member at the highest frequency they may have
+        # unadded tracks at, in order, by member number
+        self.views = None
+
+        # Position in views of each member's most popular track that may not
+        # have been added yet, by member number
+        self.cursors = None
+
+        # Position in tracks_of_member where each member's next view starts, by member number
+        self.view_ends = None
 
-        self.collab.sort(key=Track.frequency, reverse=True)
+        # Ranks of the tracks in the collab, in the order they were added
+        self.collab = None
 
-        return self.collab
+        # Number of unadded tracks at each frequency
+        self.num_tracks_left_for_freq = None
+
+        # How many tracks each member has added, by member number
+        self.num_tracks_added_for_member = None
+
+    @staticmethod
+    def from_track_members(members, track_members, max_collab_size=MAX_COLLAB_SIZE, seed=None):
+        builder = BitsetCollabBuilder([], max_collab_size, seed)
+        builder.members.extend(dict.fromkeys(members))
+        builder.track_members = track_members
+        return builder
+
+    # Rank the tracks owned by at least MIN_FREQUENCY members from most to least
+    # popular, and record which members own each one
+    def __create_track_list(self):
+        if self.track_members is None:
+            member_numbers = dict()
+            owners_of_track = dict()
+            for playlist in self.playlists:
+                member_number = member_numbers.get(playlist.member)
+                if member_number is None:
+                    member_number = member_numbers[playlist.member] = len(self.members)
+                    self.members.append(playlist.member)
+                member_bit = 1 << member_number
+                for track in playlist.tracks:
+                    owners_of_track[track] = owners_of_track.get(track, 0) | member_bit
+        else:
+            member_numbers = {member: i for i, member in enumerate(self.members)}
+            owners_of_track = dict()
+            for track, members_of_track in self.track_members.items():
+                owners = 0
+                for member in members_of_track:
+                    owners |= 1 << member_numbers[member]
+                owners_of_track[track] = owners
+
+        tracks = [(track, owners) for track, owners in owners_of_track.items() if bit_count(owners) >= MIN_FREQUENCY]
+        del owners_of_track
+        keys = [track.sort_key() for track, _ in tracks]
+        by_key = sorted(range(len(tracks)), key=keys.__getitem__)
+        frequencies = [bit_count(owners) for _, owners in tracks]
+        ranked = sorted(by_key, key=frequencies.__getitem__, reverse=True)
+
+        self.tracks = [tracks[i][0] for i in ranked]
+        self.owners = [tracks[i][1] for i in ranked]
+        self.frequencies = [frequencies[i] for i in ranked]
+        rank_of = {i: rank for rank, i in enumerate(ranked)}
+        self.ranks_by_key = [rank_of[i] for i in by_key]
+        for rank, frequency in enumerate(self.frequencies):
+            self.first_rank_of_freq.setdefault(frequency, rank)
+            self.end_rank_of_freq[frequency] = rank + 1
+
+    # Record the ranks of the tracks each member owns, in order
+    # The dummy member's ranks aren't stored, since it owns every track
+    def __link_tracks(self):
+        self.tracks_of_member = [None] + [array("I") for _ in self.members[1:]]
+        for rank, owners in enumerate(self.owners):
+            for member_number in bits(owners):
+                self.tracks_of_member[member_number].append(rank)
+
+    # Break ties between tracks of the same frequency with the given seed, the
+    # same way CollabBuilder does, and start a new collab
+    def __shuffle(self, seed):
+        self.order = list(self.ranks_by_key)
+        random.Random(seed).shuffle(self.order)
+        self.order.sort(key=self.frequencies.__getitem__, reverse=True)
+        self.position = array("I", bytes(4 * len(self.order)))
+        for position, rank in enumerate(self.order):
+            self.position[rank] = position
+
+        self.added = bytearray(len(self.order))
+        self.views = [self.order] + [[] for _ in self.members[1:]]
+        self.cursors = [0] * len(self.members)
+        self.view_ends = [0] * len(self.members)
+        self.collab = []
+        self.num_tracks_left_for_freq = Counter(self.frequencies)
+        self.num_tracks_added_for_member = [0] * len(self.members)
+
+    # Return the rank of the given member's most popular track that hasn't been
+    # added yet, or None if they have none left
+    # A member's tracks are put in this collab's order one frequency at a time,
+    # as they reach it
+    def __get_most_popular_track_of_member(self, member_number):
+        view = self.views[member_number]
+        cursor = self.cursors[member_number]
+        while True:
+            while cursor < len(view) and self.added[view[cursor]]:
+                cursor += 1
+            self.cursors[member_number] = cursor
+            if cursor < len(view):
+                return view[cursor]
+
+            # Move on to the member's tracks at their next highest frequency
+            ranks = self.tracks_of_member[member_number]
+            start = self.view_ends[member_number]
+            if member_number == 0 or start == len(ranks):
+                return None
+            end = bisect_left(ranks, self.end_rank_of_freq[self.frequencies[ranks[start]]], start)
+            view = self.views[member_number] = sorted(ranks[start:end], key=self.position.__getitem__)
+            self.view_ends[member_number] = end
+            cursor = 0
+
+    # Add the track with the given rank to the collab
+    def __consume_track(self, rank):
+        self.collab.append(rank)
+        self.added[rank] = 1
+
+        frequency = self.frequencies[rank]
+        self.num_tracks_left_for_freq[frequency] -= 1
+        if self.num_tracks_left_for_freq[frequency] == 0:
+            del self.num_tracks_left_for_freq[frequency]
+
+        self.num_tracks_added_for_member[0] += 1
+        for member_number in bits(self.owners[rank]):
+            self.num_tracks_added_for_member[member_number] += 1
+
+    # Make sure each member reaches a minimum threshold of tracks in the collab
+    # Give up on a member if they don't have enough tracks to reach the threshold
+    def __give_members_minimum_share(self):
+        min_tracks_per_member = int(self.max_collab_size / (len(self.members) - 1) * MIN_SHARE_FACTOR)
+        for member_number in range(len(self.members)):
+            num_tracks_needed = min_tracks_per_member - self.num_tracks_added_for_member[member_number]
+            for _ in range(num_tracks_needed):
+                rank = self.__get_most_popular_track_of_member(member_number)
+                if rank is None:
+                    break  # This member has no songs left
+                self.__consume_track(rank)
+
+    # Consume the highest frequencies until one frequency can't be added entirely
+    # without exceeding the max collab size or no tracks are left
+    # Tracks of the same frequency take up the same positions in every order
+    def __add_all_of_highest_frequencies(self):
+        while len(self.num_tracks_left_for_freq) > 0:
+            frequency = self.frequencies[self.__get_most_popular_track_of_member(0)]
+            if self.num_tracks_left_for_freq[frequency] + len(self.collab) > self.max_collab_size:
+                return
+            for position in range(self.first_rank_of_freq[frequency], self.end_rank_of_freq[frequency]):
+                rank = self.order[position]
+                if not self.added[rank]:
+                    self.__consume_track(rank)
+
+    # Fill the rest of the playlist with tracks from the highest frequency level
+    # remaining, prioritizing the tracks of members with the least songs added
+    def __add_some_of_last_frequency(self):
+        if len(self.num_tracks_left_for_freq) == 0:
+            return
+        last_frequency = self.frequencies[self.__get_most_popular_track_of_member(0)]
+
+        # Min-heap of (tracks added, member number), refreshed lazily like CollabBuilder's
+        heap = [(num_tracks_added, i) for i, num_tracks_added in enumerate(self.num_tracks_added_for_member)]
+        heapq.heapify(heap)
+
+        while len(self.collab) < self.max_collab_size and heap:
+            num_tracks_added, member_number = heap[0]
+            if num_tracks_added != self.num_tracks_added_for_member[member_number]:
+                heapq.heapreplace(heap, (self.num_tracks_added_for_member[member_number], member_number))
+                continue
+
+            rank = self.__get_most_popular_track_of_member(member_number)
+            if rank is None or self.frequencies[rank] < last_frequency:
+                heapq.heappop(heap)
+                continue
+
+            self.__consume_track(rank)
+
+    # Make a collaborative playlist (collab) out of the playlists of each squad member
+    def build(self):
+        return self.build_variants([self.seed])[0]
+
+    # Make one collab for each of the given seeds
+    # Ranking and linking the tracks is only done once, so each extra collab
+    # only costs choosing its tracks
+    def build_variants(self, seeds):
+        if self.tracks is None:
+            with collab_build_seconds.time(phase="create_track_list"):
+                self.__create_track_list()
+            with collab_build_seconds.time(phase="link_tracks"):
+                self.__link_tracks()
+
+        collabs = []
+        for seed in seeds:
+            self.__shuffle(seed)
+            with collab_build_seconds.time(phase="minimum_share"):
+                self.__give_members_minimum_share()
+            with collab_build_seconds.time(phase="highest_frequencies"):
+                self.__add_all_of_highest_frequencies()
+            with collab_build_seconds.time(phase="last_frequency"):
+                self.__add_some_of_last_frequency()
+
+            self.collab.sort(key=self.frequencies.__getitem__, reverse=True)
+            collabs.append([self.tracks[rank] for rank in self.collab])
+
+        return collabs
+
+
+# Return a builder for tracks whose owners were already worked out, using the
+# engine that suits the squad's size
+def builder_from_track_members(members, track_members, max_collab_size=MAX_COLLAB_SIZE, seed=None):
+    if len(set(members)) >= BITSET_ENGINE_MIN_MEMBERS:
+        return BitsetCollabBuilder.from_track_members(members, track_members, max_collab_size, seed)
+    return CollabBuilder.from_track_members(members, track_members, max_collab_size, seed)
+
+
+# Return the number of bits set in an int
+def bit_count(n):
+    return bin(n).count("1")
+
+
+# Yield the positions of the bits set in an int, lowest first
+def bits(n):
+    while n:
+        lowest_bit = n & -n
+        yield lowest_bit.bit_length() - 1
+        n ^= lowest_bit
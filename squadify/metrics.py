@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+# Whether to log how long each page request spent in each histogram
+LOG_REQUEST_TIMINGS = os.getenv("LOG_REQUEST_TIMINGS") == "1"
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+# Every histogram, in the order they're shown on /metrics
+histograms = []
+
+# Per-thread breakdown of the time spent in each histogram, while one is being recorded
+local = threading.local()
+
+
+# A Prometheus-style histogram of durations, with one series per set of labels
+# Each worker process keeps its own counts
+class Histogram:
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.series = dict()  # Sorted label pairs -> [count in each bucket, sum, count]
+        self.lock = threading.Lock()
+        histograms.append(self)
+
+    # Record a duration in seconds
+    def observe(self, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += seconds
+            series[2] += 1
+
+        breakdown = getattr(local, "breakdown", None)
+        if breakdown is not None:
+            total, count = breakdown.get(self.name, (0, 0))
+            breakdown[self.name] = (total + seconds, count + 1)
+
+    # Record how long the body of a with statement takes
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # Decorator that records how long each call takes, labeled with the function's name
+    def timed(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with self.time(operation=f.__qualname__):
+                return f(*args, **kwargs)
+        return wrapper
+
+    # Return this histogram in the Prometheus text format
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.series.items())
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+# Return every histogram in the Prometheus text format
+def render():
+    return "".join(histogram.render() for histogram in histograms)
+
+
+# Start recording how much time this thread spends in each histogram
+def start_breakdown():
+    local.breakdown = dict()
+
+
+# Stop recording and return the time and number of observations for each
+# histogram since start_breakdown()
+def finish_breakdown():
+    breakdown = getattr(local, "breakdown", None) or dict()
+    local.breakdown = None
+    return breakdown
+
+
+http_request_seconds = Histogram("squadify_http_request_seconds", "Time spent handling each page request")
+spotify_request_seconds = Histogram("squadify_spotify_request_seconds", "Time spent on each Spotify API request")
+spotify_rate_limit_wait_seconds = Histogram(
+    "squadify_spotify_rate_limit_wait_seconds", "Time spent waiting on the Spotify API rate limiter"
+)
+spotify_operation_seconds = Histogram("squadify_spotify_operation_seconds", "Time spent in each SpotifyAPI operation")
+mongo_operation_seconds = Histogram("squadify_mongo_operation_seconds", "Time spent in each database operation")
+collab_build_seconds = Histogram("squadify_collab_build_seconds", "Time spent in each phase of building a collab")
@@ -0,0 +1,38 @@
+import threading
+import time
+
+
+# A thread-safe token bucket that lets through at most rate requests a second on
+# average, and bursts of up to burst requests at once
+# Everything waiting on the bucket can also be paused, like when a server asks
+# us to back off for a while
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Wait until a request is allowed through, then take a token for it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    # Hold back every request for the given number of seconds
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            # Start refilling from empty once the pause is over
+            self.tokens = 0
+            self.last_refill = max(self.last_refill, self.paused_until)
@@ -1,13 +1,27 @@
+import hashlib
 import os
+import time
 import uuid
-from flask import render_template, request, redirect
+from flask import Blueprint, render_template, request, redirect, abort, jsonify, g, current_app, session
 from functools import wraps
 from urllib.parse import urlparse
-from spotipy.oauth2 import SpotifyOAuth
-from .spotify_api import SpotifyAPI
-from .make_collab import Playlist, CollabBuilder
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+from flask_wtf.csrf import generate_csrf
+from .spotify_api import SpotifyAPI, SpotifyOAuth
+from .cache import TTLCache, MISSING
 from .forms import *
-from . import app, database
+from . import database, jobs, metrics
+
+
+SQUAD_FRAGMENT_CACHE_SIZE = 1000  # Max number of rendered squads each worker keeps in memory
+SQUAD_FRAGMENT_CACHE_TTL = 3600  # Longest a rendered squad stays in memory, in seconds
+
+blueprint = Blueprint("squadify", __name__)
+
+# The part of each squad page that's the same for every user, keyed by
+# (squad ID, version), so a squad that changes is rendered again under its new version
+squad_fragment_cache = TTLCache(SQUAD_FRAGMENT_CACHE_SIZE, SQUAD_FRAGMENT_CACHE_TTL)
 
 
 # Apply to pages where it is either optional or required that the user be signed in
@@ -21,7 +35,12 @@ def authenticate(required):
 
             if auth_manager.validate_token(cache_handler.get_cached_token()):
                 # User is not signed in
-                spotify_api = SpotifyAPI(auth_manager=auth_manager)
+                spotify_api = SpotifyAPI(
+                    auth_manager=auth_manager,
+                    track_cache=database.MongoTrackCache(),
+                    liked_songs_sync=database.MongoLikedSongsSync(),
+                    profile_cache=cache_handler,
+                )
                 kwargs["spotify_api"] = spotify_api
                 if not required:
                     kwargs["signed_in"] = True
@@ -38,14 +57,69 @@ def authenticate(required):
     return decorator
 
 
+# Time every request, and if LOG_REQUEST_TIMINGS is set, log where the time went
+@blueprint.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if metrics.LOG_REQUEST_TIMINGS:
+        metrics.start_breakdown()
+
+
+@blueprint.after_app_request
+def stop_request_timer(response):
+    elapsed = time.perf_counter() - g.request_start
+    if metrics.LOG_REQUEST_TIMINGS:
+        breakdown = ", ".join(
+            f"{name} {total * 1000:.1f} ms x{count}" for name, (total, count) in metrics.finish_breakdown().items()
+        )
+        current_app.logger.info(
+            f"{request.method} {request.full_path.rstrip('?')} {response.status_code} in {elapsed * 1000:.1f} ms: {breakdown}"
+        )
+    metrics.http_request_seconds.observe(
+        elapsed, endpoint=request.endpoint or "unmatched", method=request.method, status=str(response.status_code)
+    )
+    return response
+
+
+# Return a 304 Not Modified response if the client's copy of a page is still
+# current, going by the ETag and last-modified time the page would have, or
+# else a response with the page returned by render()
+# The ETag is made from etag_parts, which must cover everything the page shows
+# The page may only be cached by the user's browser, which has to check with
+# us before showing it again
+def conditional_response(etag_parts, render, last_modified=None):
+    etag = hashlib.sha1(repr(etag_parts).encode()).hexdigest()
+    if is_resource_modified(request.environ, etag, last_modified=last_modified):
+        response = current_app.make_response(render())
+    else:
+        response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+# The part of a page's ETag for the CSRF token in its forms
+# It changes with the session's token, and often enough that a page shown from
+# the browser's cache never has a token more than half its time limit old
+def csrf_etag_part():
+    generate_csrf()  # Makes the session's token if it doesn't have one yet
+    time_limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    period = int(time.time() // (time_limit / 2)) if time_limit else 0
+    return session.get(current_app.config.get("WTF_CSRF_FIELD_NAME", "csrf_token")), period
+
+
 # Signs in a user
 # Route flow: <Page> -> /sign_in -> <Spotify login> -> /sign_in -> <Dest>
 # <Dest> is either the dest parameter, the previous page, or / in that order
-@app.get("/sign_in")
+@blueprint.get("/sign_in")
 def sign_in():
+    cache_handler = database.spotify_cache_handler()
     auth_manager = SpotifyOAuth(
         scope="playlist-modify-public,user-library-read",  # Edit public playlist and view user library
-        cache_handler=database.spotify_cache_handler(),
+        cache_handler=cache_handler,
         show_dialog=True,
         redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI") + "/sign_in",  # Have Spotify send us back here after signing in
         state=request.args.get("dest", request.referrer or "/")  # After being sent back here, go to this url
@@ -56,12 +130,14 @@ def sign_in():
         return redirect(auth_manager.get_authorize_url())
     else:
         # Step 2. Got sent back here, get Spotify access token, and then redirect to final destination
+        # Forget any previous sign in first, so we don't keep its token or profile
+        cache_handler.delete_token_from_cache()
         auth_manager.get_access_token(request.args.get("code"))
         return redirect(request.args.get("state"))
 
 
 # Signs out a user
-@app.get("/sign_out")
+@blueprint.get("/sign_out")
 def sign_out():
     database.spotify_cache_handler().delete_token_from_cache()
     print("sign out")
@@ -69,37 +145,57 @@ def sign_out():
 
 
 # Homepage
-@app.get("/")
+@blueprint.get("/")
 @authenticate(required=False)
 def homepage(spotify_api, signed_in):
     return render_template("index.html", signed_in=signed_in)
 
 
 # View list of user's squads
-@app.get("/squads")
+@blueprint.get("/squads")
 @authenticate(required=True)
 def view_squads(spotify_api):
-    return render_template(
-        "squads-list.html",
-        signed_in=True,
-        squads_list=database.get_user_squad_list(spotify_api),
+    squads_list, next_page = database.get_user_squad_list(spotify_api, request.args.get("after"))
+    return conditional_response(
+        ("squads", [(squad["squad_id"], squad["squad_name"]) for squad in squads_list], next_page),
+        lambda: render_template(
+            "squads-list.html",
+            signed_in=True,
+            squads_list=squads_list,
+            next_page=next_page,
+        ),
     )
 
 
 # View a specific squad
-@app.get("/squads/<squad:squad>")
+@blueprint.get("/squads/<squad:squad>")
 @authenticate(required=False)
 def view_squad(spotify_api, signed_in, squad):
-    return render_template(
-        "squad-page.html",
-        squad=squad,
-        signed_in=signed_in,
-        add_playlist_form=AddPlaylistForm(),
+    # The squad's version is all that's needed to tell whether the page changed,
+    # and its playlists are only loaded if it isn't already rendered
+    squad.load("squad_name", "version", "modified_at")
+    version = squad.get("version", 0)  # Squads made before versions were added
+
+    def render():
+        fragment = squad_fragment_cache.get((squad["squad_id"], version))
+        if fragment is MISSING:
+            fragment = render_template("components/squad-playlists.html", squad=squad.load("leader_name", "playlists", "latest_collab"))
+            squad_fragment_cache.set((squad["squad_id"], version), fragment)
+        return render_template(
+            "squad-page.html",
+            squad=squad,
+            squad_fragment=Markup(fragment),
+            signed_in=signed_in,
+            add_playlist_form=AddPlaylistForm(),
+        )
+
+    return conditional_response(
+        ("squad", squad["squad_id"], version, signed_in, csrf_etag_part()), render, squad["modified_at"]
     )
 
 
 # Create a new squad
-@app.route("/squads/new", methods=["GET", "POST"])
+@blueprint.route("/squads/new", methods=["GET", "POST"])
 @authenticate(required=True)
 def new_squad(spotify_api):
     new_squad_form = NewSquadForm()
@@ -114,7 +210,7 @@ def new_squad(spotify_api):
 
 
 # Delete an existing squad
-@app.get("/squads/<squad:squad>/delete_squad")
+@blueprint.get("/squads/<squad:squad>/delete_squad")
 @authenticate(required=True)
 def delete_squad(spotify_api, squad):
     # Only the squad leader is allowed to delete a squad
@@ -130,13 +226,14 @@ def delete_squad(spotify_api, squad):
 # Note 2: A user can opt to add their liked songs as a playlist, but since
 # Spotify doesn't treat liked songs as a playlist, we must make a playlist on
 # their account and add their liked songs to that playlist
-@app.post("/squads/<squad:squad>/add_playlist")
+@blueprint.post("/squads/<squad:squad>/add_playlist")
 @authenticate(required=False)
 def add_playlist(spotify_api, signed_in, squad):
     add_playlist_form = AddPlaylistForm()
 
     # Add a playlist only if the user submitted the playlist info
     if add_playlist_form.validate_on_submit():
+        squad.load()
         if add_playlist_form.use_liked_songs.data:
             # Use liked songs
             if not signed_in:
@@ -146,6 +243,7 @@ def add_playlist(spotify_api, signed_in, squad):
         else:
             # Use provided playlist link
             playlist_id = urlparse(add_playlist_form.playlist_link.data).path.split("/")[-1]
+        # The playlist's tracks are added to the squad's track index by the next compile
         database.add_playlist_to_squad(squad["squad_id"], playlist_id, add_playlist_form.user_name.data)
 
     # Regardless of whether or not a playlist was added, redirect back to the squad page
@@ -153,34 +251,95 @@ def add_playlist(spotify_api, signed_in, squad):
 
 
 # Delete a playlist from an existing squad
-@app.get("/squads/<squad:squad>/delete_playlist")
+@blueprint.get("/squads/<squad:squad>/delete_playlist")
 def delete_playlist(squad):
+    # Removing a playlist only touches its own tracks, so it's removed from the
+    # squad's track index right away instead of by the next compile
+    squad.load()
     database.delete_playlist_from_squad(squad["squad_id"], request.args.get("playlist_id"), request.args.get("user_name"))
+    database.remove_playlist_from_track_index(squad["squad_id"], request.args.get("playlist_id"), request.args.get("user_name"))
 
     # Redirect to squad page
     return redirect(f"/squads/{squad['squad_id']}")
 
 
-# Create a collab and display a link to it
-@app.get("/squads/<squad:squad>/compile")
+# Start compiling a collab in the background and go to its progress page
+# Pass a seed to get the same collabs as an earlier compile of the same playlists
+@blueprint.get("/squads/<squad:squad>/compile")
 @authenticate(required=True)
 def compile_squad(spotify_api, squad):
-    # Transform playlists list and filter out invalid playlist ids
-    playlists = [(playlist["user_name"], playlist["playlist_id"]) for playlist in squad["playlists"]]
-    playlists = filter(lambda playlist: spotify_api.is_valid_playlist_id(playlist[1]), playlists)
-    playlists = [Playlist(name, spotify_api.get_playlist_tracks(id)) for name, id in playlists]
+    # Do nothing if the squad has no playlists
+    squad.load("squad_name", "playlists", "collabs")
+    if len(squad["playlists"]) == 0:
+        return redirect(f"/squads/{squad['squad_id']}")
+
+    job_id = jobs.start_compile_job(spotify_api, squad, request.args.get("seed", type=int))
+    return redirect(f"/squads/{squad['squad_id']}/compile/{job_id}")
 
-    # Do nothing if the squad has no valid playlists
-    if len(playlists) == 0:
+
+# Write the collab compile-all last built for this squad to the user's collab
+# playlist in the background, and go to its progress page
+@blueprint.get("/squads/<squad:squad>/compile/latest")
+@authenticate(required=True)
+def use_latest_collab(spotify_api, squad):
+    # Do nothing if compile-all hasn't built one yet
+    squad.load("squad_name", "playlists", "collabs", "latest_collab")
+    if squad["latest_collab"] is None:
         return redirect(f"/squads/{squad['squad_id']}")
 
-    # Build a collaborative playlist from this squad
-    collab = CollabBuilder(playlists).build()
-    collab_id = spotify_api.create_playlist_with_tracks(squad["squad_name"], collab)
+    job_id = jobs.start_latest_collab_job(spotify_api, squad)
+    return redirect(f"/squads/{squad['squad_id']}/compile/{job_id}")
+
+
+# Show a compile job's progress, or once it's done, a link to the collab
+@blueprint.get("/squads/<squad:squad>/compile/<job_id>")
+@authenticate(required=True)
+def view_compile_job(spotify_api, squad, job_id):
+    job = jobs.get_job(job_id)
+    if job is None or job["squad_id"] != squad["squad_id"]:
+        abort(404)
+
+    squad.load("squad_name")
+    if job["status"] != jobs.JOB_DONE:
+        return render_template("compile-progress.html", signed_in=True, squad=squad, job=job)
 
     return render_template(
         "compile-squad.html",
         signed_in=True,
         squad=squad,
-        playlist_embed_id=collab_id,
+        job=job,
+        playlist_embed_id=job["collab_id"],
+        skipped_playlists=job["skipped_playlists"],
     )
+
+
+# Replace the user's collab playlist with another of the collabs a compile built
+@blueprint.get("/squads/<squad:squad>/compile/<job_id>/variant/<int:variant>")
+@authenticate(required=True)
+def use_compile_variant(spotify_api, squad, job_id, variant):
+    job = jobs.get_job(job_id)
+    if job is None or job["squad_id"] != squad["squad_id"] or variant >= len(job["variants"]):
+        abort(404)
+
+    squad.load("squad_name", "collabs")
+    jobs.use_variant(spotify_api, squad, job, variant)
+    return redirect(f"/squads/{squad['squad_id']}/compile/{job_id}")
+
+
+# Report a compile job's progress for the progress page to poll
+@blueprint.get("/squads/<squad:squad>/compile/<job_id>/status")
+def compile_job_status(squad, job_id):
+    job = jobs.get_job(job_id)
+    if job is None or job["squad_id"] != squad["squad_id"]:
+        abort(404)
+
+    job.pop("created_at")
+    job.pop("updated_at")
+    job.pop("variants")  # Only the compile page needs the tracks
+    return jsonify(job)
+
+
+# Timing histograms of this worker process in the Prometheus text format
+@blueprint.get("/metrics")
+def view_metrics():
+    return current_app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -1,5 +1,19 @@
-from spotipy import Spotify
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
+import spotipy.oauth2
+from spotipy import Spotify, SpotifyException
 from .make_collab import Track
+from .rate_limit import TokenBucket
+from .metrics import spotify_request_seconds, spotify_rate_limit_wait_seconds, spotify_operation_seconds
 
 
 TRACK_PULL_LIMIT = 100  # Number of tracks the Spotify API lets you query at once
@@ -9,78 +23,465 @@ PLAYLIST_PULL_LIMIT = 50  # Number of playlists the Spotify API lets you query a
 LIKED_SONGS_PULL_LIMIT = 50  # Number of liked songs the Spotify API lets you query at once
 LIKED_SONGS_PLAYLIST_NAME = "Liked Songs"
 
+# The only parts of a page of playlist tracks we use, so Spotify can leave out
+# album art, markets and everything else we'd have to download and parse
+PLAYLIST_TRACK_FIELDS = "items(track(id,name,artists(name))),next,total,limit,offset"
+PLAYLIST_FETCH_CONCURRENCY = 8  # Max number of playlists we download from the Spotify API at once
+PAGE_FETCH_CONCURRENCY = 4  # Max number of pages of one list we download from the Spotify API at once
+
+# Where the Spotify Web API and accounts service are, read from the environment
+# so the app can be pointed at a stand-in, like the load test's fake Spotify
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1/")
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+
+# Spotify API request budget, read from the environment
+# The budget is shared by the whole deployment, so each worker process gets an
+# equal share of it, going by the worker count gunicorn is given
+SPOTIFY_REQUESTS_PER_SECOND = float(os.getenv("SPOTIFY_REQUESTS_PER_SECOND", "25"))
+SPOTIFY_REQUEST_BURST = float(os.getenv("SPOTIFY_REQUEST_BURST", "25"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))  # Number of worker processes
+
+HTTP_POOL_SIZE = 32  # Max keep-alive connections to the Spotify API per worker process
+HTTP_RETRIES = 3  # Number of times a request is retried after a connection error or server error
+RATE_LIMIT_RETRIES = 3  # Number of times a request is retried after being rate limited
+MAX_RETRY_AFTER = 30  # Longest we'll wait when rate limited before giving up, in seconds
+
+session = None  # This process's connection pool to the Spotify API, created on first use
+rate_limiter = None  # This process's share of the request budget
+http_lock = threading.Lock()
+
+
+# Return this process's requests session and rate limiter, creating them the
+# first time they're needed
+# Every SpotifyAPI in the process shares them, so connections stay open between
+# requests and the request budget holds across all threads
+def get_http():
+    global session, rate_limiter
+    with http_lock:
+        if session is None:
+            # Server errors are retried by the session, but rate limiting is left
+            # to SpotifyAPI so that every thread backs off together
+            retry = Retry(
+                total=HTTP_RETRIES,
+                read=False,
+                allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+                status_forcelist=(500, 502, 503, 504),
+                backoff_factor=0.3,
+                respect_retry_after_header=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+
+            rate = SPOTIFY_REQUESTS_PER_SECOND / WEB_CONCURRENCY
+            rate_limiter = TokenBucket(rate, max(1, SPOTIFY_REQUEST_BURST / WEB_CONCURRENCY))
+    return session, rate_limiter
+
+
+# A forked worker can't share its parent's connections, and gets its own budget
+def forget_http_after_fork():
+    global session, rate_limiter, http_lock
+    session = None
+    rate_limiter = None
+    http_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=forget_http_after_fork)
+
+# Spotipy's auth managers, signing in through SPOTIFY_ACCOUNTS_URL
+class SpotifyOAuth(spotipy.oauth2.SpotifyOAuth):
+    OAUTH_AUTHORIZE_URL = f"{SPOTIFY_ACCOUNTS_URL}/authorize"
+    OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+
+
+class SpotifyClientCredentials(spotipy.oauth2.SpotifyClientCredentials):
+    OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+
+
+# Reasons a playlist can fail to download
+PLAYLIST_NOT_FOUND = "not found"
+PLAYLIST_PRIVATE = "private"
+PLAYLIST_RATE_LIMITED = "rate limited"
+PLAYLIST_UNAVAILABLE = "unavailable"
+
 
 # Added functionality on top of the Spotipy module
 class SpotifyAPI(Spotify):
 
+    # track_cache optionally stores playlist track lists between calls (see database.MongoTrackCache)
+    # liked_songs_sync optionally remembers each user's last Liked Songs sync (see database.MongoLikedSongsSync)
+    # profile_cache optionally stores this user's profile between calls (see database.MongoCacheHandler)
+    def __init__(self, *args, track_cache=None, liked_songs_sync=None, profile_cache=None, **kwargs):
+        shared_session, self.rate_limiter = get_http()
+        kwargs.setdefault("requests_session", shared_session)
+        super().__init__(*args, **kwargs)
+        self.prefix = SPOTIFY_API_URL
+        self.track_cache = track_cache
+        self.liked_songs_sync = liked_songs_sync
+        self.profile_cache = profile_cache
+        self.__profile = None
+
+
+    # Spotipy closes the session when an instance is garbage collected, but the
+    # shared session has to stay open for the rest of the process
+    def __del__(self):
+        if self._session is not session:
+            super().__del__()
+
+
+    # Send a request once the rate limiter allows it
+    # When Spotify says we're sending too many requests, every thread in this
+    # process waits as long as Spotify asks before the request is retried
+    def _internal_call(self, method, url, payload, params):
+        endpoint = self.__endpoint(url)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            start = time.perf_counter()
+            self.rate_limiter.acquire()
+            spotify_rate_limit_wait_seconds.observe(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            status = "ok"
+            try:
+                return super()._internal_call(method, url, payload, params)
+            except SpotifyException as e:
+                status = str(e.http_status)
+                retry_after = self.__retry_after(e)
+                if retry_after is None or retry_after > MAX_RETRY_AFTER or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                self.rate_limiter.pause(retry_after)
+            except RequestException:
+                status = "error"
+                raise
+            finally:
+                spotify_request_seconds.observe(time.perf_counter() - start, method=method, endpoint=endpoint, status=status)
+
+
+    # Return this user's ID and display name
+    # The profile is only requested from Spotify once per instance, or once per
+    # session with a profile cache
+    # Also used by current_user()
+    def me(self):
+        if self.__profile is None:
+            profile = self.profile_cache.get_cached_profile() if self.profile_cache else None
+            if profile is None:
+                user = super().me()
+                profile = dict(id=user["id"], display_name=user["display_name"])
+                if self.profile_cache:
+                    self.profile_cache.save_profile_to_cache(profile)
+            self.__profile = profile
+        return self.__profile
+
+
     # Return a list of all the tracks from a playlist
+    # With a track cache, an unchanged playlist only costs one request for its snapshot ID
+    @spotify_operation_seconds.timed
     def get_playlist_tracks(self, playlist_id):
-        return self.__pull_tracks(self.playlist_items(playlist_id, limit=TRACK_PULL_LIMIT))
+        if self.track_cache is None:
+            return self.__download_tracks(playlist_id)
+        return self.__get_tracks_at_snapshot(playlist_id, self.__get_snapshot_id(playlist_id))
+
+
+    # Return (tracks, None) for a playlist, or (None, reason) if it can't be
+    # downloaded, where reason is one of the PLAYLIST_* failure reasons
+    # Validation is folded into the first request for the playlist, so there's no
+    # separate request just to check that it exists
+    def fetch_playlist_tracks(self, playlist_id):
+        try:
+            return self.get_playlist_tracks(playlist_id), None
+        except SpotifyException as e:
+            return None, self.__failure_reason(e)
+        except RequestException:
+            return None, PLAYLIST_UNAVAILABLE
+
+
+    # Return (snapshot ID, tracks, None) for a playlist, or (None, None, reason)
+    # if it can't be downloaded, where reason is one of the PLAYLIST_* failure reasons
+    # If the playlist is still at the given snapshot ID, its tracks aren't
+    # downloaded and None is returned for them
+    def fetch_playlist_changes(self, playlist_id, snapshot_id=None):
+        try:
+            new_snapshot_id = self.__get_snapshot_id(playlist_id)
+            if new_snapshot_id == snapshot_id:
+                return new_snapshot_id, None, None
+            return new_snapshot_id, self.__get_tracks_at_snapshot(playlist_id, new_snapshot_id), None
+        except SpotifyException as e:
+            return None, None, self.__failure_reason(e)
+        except RequestException:
+            return None, None, PLAYLIST_UNAVAILABLE
+
+
+    # Given a list of (member, playlist ID) pairs and a dictionary of the snapshot
+    # ID each (playlist ID, member) was last downloaded at, download the playlists
+    # that are new or have changed since
+    # Returns a list of (member, playlist ID, snapshot ID, tracks) in the same
+    # order, with tracks being None for unchanged playlists, and a list of
+    # (member, playlist ID, reason) for the playlists that couldn't be downloaded
+    # Playlists are checked concurrently, at most max_workers at a time, so this
+    # takes about as long as the slowest playlist instead of the sum of all of them
+    # If given, on_fetched is called after each playlist is checked or skipped
+    @spotify_operation_seconds.timed
+    def get_playlist_changes(self, members_and_ids, snapshots, max_workers=PLAYLIST_FETCH_CONCURRENCY, on_fetched=None):
+        members_and_ids = list(members_and_ids)
+        results = self.__fetch_all(
+            lambda member, playlist_id: self.fetch_playlist_changes(playlist_id, snapshots.get((playlist_id, member))),
+            members_and_ids,
+            max_workers,
+            on_fetched,
+        )
+
+        changes = []
+        skipped = []
+        for (member, playlist_id), (snapshot_id, tracks, reason) in zip(members_and_ids, results):
+            if reason is None:
+                changes.append((member, playlist_id, snapshot_id, tracks))
+            else:
+                skipped.append((member, playlist_id, reason))
+        return changes, skipped
 
 
     # Create a new playlist contianing the given tracks to this user's account
+    # If given, on_pushed is called with the number of tracks in each batch pushed
     # Returns the ID of the new playlist
-    def create_playlist_with_tracks(self, playlist_name, tracks):
+    @spotify_operation_seconds.timed
+    def create_playlist_with_tracks(self, playlist_name, tracks, on_pushed=None):
         playlist_id = self.__create_playlist(playlist_name)
-        self.__push_tracks(playlist_id, tracks)
+        self.__push_tracks(playlist_id, tracks, on_pushed)
         return playlist_id
 
 
+    # Make an existing playlist contain exactly the given tracks, in order
+    # Nothing is written if it already does, otherwise its tracks are replaced in bulk
+    # If given, on_pushed is called with the number of tracks in each batch written
+    # Returns false if the playlist doesn't exist, can't be read, or this user
+    # deleted it from their library
+    @spotify_operation_seconds.timed
+    def replace_playlist_tracks(self, playlist_id, tracks, on_pushed=None):
+        if not self.__is_following(playlist_id):
+            return False
+        old_tracks, reason = self.fetch_playlist_tracks(playlist_id)
+        if reason is not None:
+            return False
+
+        track_ids = [track.id for track in tracks]
+        if [track.id for track in old_tracks] == track_ids:
+            if on_pushed:
+                on_pushed(len(track_ids))
+            return True
+
+        # Replacing sets the first batch, and the rest are appended after it
+        self.playlist_replace_items(playlist_id, track_ids[:TRACK_PUSH_LIMIT])
+        if on_pushed:
+            on_pushed(min(len(track_ids), TRACK_PUSH_LIMIT))
+        self.__push_tracks(playlist_id, tracks[TRACK_PUSH_LIMIT:], on_pushed)
+        return True
+
+
     # Copy this user's Liked Songs list to a playlist
-    # If such a playlist already exists, its contents are emptied and filled with an up-to-date track list
+    # If such a playlist already exists, only the songs liked or unliked since then
+    # are added to or removed from it
     # Otherwise, a new playlist is created
     # Returns the ID of the playlist
+    @spotify_operation_seconds.timed
     def clone_liked_songs(self):
-        liked_songs = self.__pull_tracks(self.current_user_saved_tracks(limit=LIKED_SONGS_PULL_LIMIT))
-        old_playlist_id = self.__get_playlist_id_from_name(LIKED_SONGS_PLAYLIST_NAME)
-        if old_playlist_id:
-            self.__purge_playlist(old_playlist_id)
-            self.__push_tracks(old_playlist_id, liked_songs)
-            return old_playlist_id
+        user_id = self.current_user()["id"] if self.liked_songs_sync else None
+        marker = self.liked_songs_sync.get_sync_marker(user_id) if self.liked_songs_sync else None
+
+        # If the user deleted the playlist from the last sync, start over as if
+        # they'd never synced
+        if marker and not self.__is_following(marker["playlist_id"]):
+            marker = None
+
+        # Only page through the songs liked since the last sync
+        items, total = self.__pull_liked_songs(added_after=marker["last_added_at"] if marker else None)
+
+        if marker and total == marker["track_count"] + len(items):
+            # Nothing was unliked since the last sync, so the new songs go on top
+            playlist_id = marker["playlist_id"]
+            self.__insert_tracks(playlist_id, self.__items_to_tracks(items))
         else:
-            return self.create_playlist_with_tracks(LIKED_SONGS_PLAYLIST_NAME, liked_songs)
+            # First sync, or songs were unliked, so diff against the whole playlist
+            if marker:
+                items, total = self.__pull_liked_songs()
+            liked_songs = self.__items_to_tracks(items)
+            playlist_id = marker["playlist_id"] if marker else self.__get_playlist_id_from_name(LIKED_SONGS_PLAYLIST_NAME)
+            if playlist_id:
+                self.__sync_playlist(playlist_id, liked_songs)
+            else:
+                playlist_id = self.create_playlist_with_tracks(LIKED_SONGS_PLAYLIST_NAME, liked_songs)
+
+        if self.liked_songs_sync:
+            last_added_at = items[0]["added_at"] if items else marker and marker["last_added_at"]
+            self.liked_songs_sync.save_sync_marker(user_id, playlist_id, last_added_at, total)
+        return playlist_id
+
+
+    # Call fetch(member, playlist ID) for each (member, playlist ID) pair, at most
+    # max_workers at a time, and return the results in the same order
+    # If given, on_fetched is called after each call
+    def __fetch_all(self, fetch, members_and_ids, max_workers, on_fetched):
+        if len(members_and_ids) == 0:
+            return []
+
+        def run(pair):
+            result = fetch(*pair)
+            if on_fetched:
+                on_fetched()
+            return result
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(members_and_ids))) as executor:
+            return list(executor.map(run, members_and_ids))
+
+
+    # Return the current snapshot ID of a playlist, which changes whenever the playlist does
+    def __get_snapshot_id(self, playlist_id):
+        return self.playlist(playlist_id, fields="snapshot_id")["snapshot_id"]
+
 
+    # Return the tracks of a playlist that's at the given snapshot ID, from the
+    # track cache if it has them
+    def __get_tracks_at_snapshot(self, playlist_id, snapshot_id):
+        if self.track_cache is None:
+            return self.__download_tracks(playlist_id)
 
-    # Returns whether this is the ID of a valid playlist
-    def is_valid_playlist_id(self, playlist_id):
+        tracks = self.track_cache.get_cached_tracks(playlist_id, snapshot_id)
+        if tracks is None:
+            tracks = self.__download_tracks(playlist_id)
+            self.track_cache.save_tracks_to_cache(playlist_id, snapshot_id, tracks)
+        return tracks
+
+
+    # Translate an error from the Spotify API into a playlist failure reason
+    def __failure_reason(self, error):
+        if error.http_status in (400, 404):
+            return PLAYLIST_NOT_FOUND  # Malformed or nonexistent playlist ID
+        if error.http_status in (401, 403):
+            return PLAYLIST_PRIVATE
+        if error.http_status == 429:
+            return PLAYLIST_RATE_LIMITED
+        return PLAYLIST_UNAVAILABLE
+
+
+    # Return the endpoint a request URL is for, with IDs taken out so requests for
+    # different playlists and users are counted together
+    def __endpoint(self, url):
+        path = urlparse(url).path if url.startswith("http") else url
+        path = path[path.find("/v1/") + len("/v1/"):] if "/v1/" in path else path
+        return re.sub(r"(playlists|users)/[^/]+", r"\1/{id}", path.strip("/"))
+
+
+    # Return how many seconds Spotify asked us to wait before retrying, or none
+    # if the error isn't a rate limit
+    def __retry_after(self, error):
+        if error.http_status != 429 or not error.headers:
+            return None
         try:
-            self.playlist(playlist_id)
-            return True
-        except:
-            return False
+            return max(0, int(error.headers.get("Retry-After", 1)))
+        except ValueError:
+            return 1
+
+
+    # Yield the pages of a paginated result in order, starting with the given first page
+    # The first page says how many items there are, so the rest of the pages are
+    # downloaded at once, at most PAGE_FETCH_CONCURRENCY at a time, and no more
+    # pages than that are held in memory waiting to be used
+    # params are added to the URL of every page after the first
+    def __pull_pages(self, result, **params):
+        yield result
+        if not result["next"]:
+            return
+
+        offsets = range(result["offset"] + result["limit"], result["total"], result["limit"])
+        urls = [self.__page_url(result["next"], offset=offset, **params) for offset in offsets]
+        if urls:
+            with ThreadPoolExecutor(max_workers=min(PAGE_FETCH_CONCURRENCY, len(urls))) as executor:
+                pending = deque()
+                for url in urls:
+                    if len(pending) == PAGE_FETCH_CONCURRENCY:
+                        result = pending.popleft().result()
+                        yield result
+                    pending.append(executor.submit(self._get, url))
+                while pending:
+                    result = pending.popleft().result()
+                    yield result
+
+        # Follow any pages added since the first page was downloaded
+        while result["next"]:
+            result = self._get(self.__page_url(result["next"], **params))
+            yield result
+
+
+    # Return the given page URL with the given query parameters changed
+    def __page_url(self, url, **params):
+        url = urlparse(url)
+        query = dict(parse_qsl(url.query))
+        query.update(params)
+        return urlunparse(url._replace(query=urlencode(query)))
 
 
     # Pull items using any initial result from a function that supports pagination
     def __pull_items(self, result):
-        # Iterate through paginated results
-        items = result["items"]
-        while result["next"]:
-            result = self.next(result)
-            items.extend(result["items"])
-        return items
+        return [item for page in self.__pull_pages(result) for item in page["items"]]
 
 
-    # Pull tracks using any initial result from a function that supports pagination
-    def __pull_tracks(self, result):
-        # Transform items into tracks and filter out ones with missing data
-        items = self.__pull_items(result)
-        items = filter(lambda item: item["track"] and item["track"]["id"], items)
-        tracks = [Track(item["track"]) for item in items]
+    # Return all the tracks of a playlist, asking only for the fields a Track needs
+    # Each page is turned into Tracks as soon as it arrives, so only a few pages of
+    # raw JSON are ever held at once
+    def __download_tracks(self, playlist_id):
+        result = self.playlist_items(playlist_id, fields=PLAYLIST_TRACK_FIELDS, limit=TRACK_PULL_LIMIT)
+        tracks = []
+        for page in self.__pull_pages(result, fields=PLAYLIST_TRACK_FIELDS):
+            tracks.extend(self.__items_to_tracks(page["items"]))
         return tracks
 
 
+    # Transform items into tracks and filter out ones with missing data
+    def __items_to_tracks(self, items):
+        items = filter(lambda item: item["track"] and item["track"]["id"], items)
+        return [Track(item["track"]) for item in items]
+
+
+    # Return this user's liked song items from newest to oldest, and the total
+    # number of liked songs
+    # If added_after is given, stop paging once we reach a song liked at or before then
+    # Those pages have to be downloaded one at a time, since we don't know where to stop
+    def __pull_liked_songs(self, added_after=None):
+        result = self.current_user_saved_tracks(limit=LIKED_SONGS_PULL_LIMIT)
+        total = result["total"]
+        if added_after is None:
+            return self.__pull_items(result), total
+        items = []
+        while True:
+            for item in result["items"]:
+                if added_after and item["added_at"] <= added_after:
+                    return items, total
+                items.append(item)
+            if not result["next"]:
+                return items, total
+            result = self.next(result)
+
+
     # Given a function that takes a playlist ID and a track list of limited size,
     # batch the given track list and call the function on each batch
-    def __modify_tracks(self, playlist_id, tracks, operation, operation_limit):
+    def __modify_tracks(self, playlist_id, tracks, operation, operation_limit, on_batch=None):
         track_ids = [track.id for track in tracks]
         for i in range(0, len(track_ids), operation_limit):
             track_id_batch = track_ids[i : min(i + operation_limit, len(track_ids))]
             operation(playlist_id, track_id_batch)
+            if on_batch:
+                on_batch(len(track_id_batch))
 
 
     # Push the given tracks to the playlist with the given ID
-    def __push_tracks(self, playlist_id, tracks):
-        self.__modify_tracks(playlist_id, tracks, self.playlist_add_items, TRACK_PUSH_LIMIT)
+    def __push_tracks(self, playlist_id, tracks, on_pushed=None):
+        self.__modify_tracks(playlist_id, tracks, self.playlist_add_items, TRACK_PUSH_LIMIT, on_pushed)
+
+
+    # Insert the given tracks at the top of the playlist with the given ID, keeping their order
+    def __insert_tracks(self, playlist_id, tracks):
+        track_ids = [track.id for track in tracks]
+        for i in range(0, len(track_ids), TRACK_PUSH_LIMIT):
+            self.playlist_add_items(playlist_id, track_ids[i : i + TRACK_PUSH_LIMIT], position=i)
 
 
     # Delete the given tracks from the playlist with the given ID
@@ -88,14 +489,33 @@ class SpotifyAPI(Spotify):
         self.__modify_tracks(playlist_id, tracks, self.playlist_remove_all_occurrences_of_items, TRACK_DELETE_LIMIT)
 
 
+    # Return whether this user follows a playlist
+    # Deleting a playlist in Spotify only unfollows it, and its owner can still
+    # read and change it, so this is the only way to tell it was deleted
+    # The endpoint is requested directly since Spotipy's playlist_is_following is
+    # deprecated and broken in some versions
+    def __is_following(self, playlist_id):
+        try:
+            return self._get(f"playlists/{playlist_id}/followers/contains", ids=self.current_user()["id"])[0]
+        except SpotifyException:
+            return False
+        except RequestException:
+            return False
+
+
     # Add a new playlist with the given name to this user's account
     def __create_playlist(self, playlist_name):
         return self.user_playlist_create(self.current_user()["id"], playlist_name)["id"]
 
 
-    # Empty a playlist of all its tracks
-    def __purge_playlist(self, playlist_id):
-        self.__delete_tracks(playlist_id, self.get_playlist_tracks(playlist_id))
+    # Make a playlist contain the given tracks by only deleting the tracks it
+    # shouldn't have and inserting the ones it's missing at the top
+    def __sync_playlist(self, playlist_id, tracks):
+        track_ids = set(track.id for track in tracks)
+        old_tracks = self.get_playlist_tracks(playlist_id)
+        old_track_ids = set(track.id for track in old_tracks)
+        self.__delete_tracks(playlist_id, [track for track in old_tracks if track.id not in track_ids])
+        self.__insert_tracks(playlist_id, [track for track in tracks if track.id not in old_track_ids])
 
 
     # Return the id of this user's playlist with the given name, or none if no such playlist exists